@@ -0,0 +1,41 @@
+import hashlib
+import numpy as np
+import torch
+
+class OnnxNet():
+    def __init__(self, path, num_threads = 0):
+        """
+        Embedding net exported to ONNX and run by ONNX Runtime on CPU, see Model.export_onnx
+
+        Parameters:
+        path (str): Path of the .onnx file
+        num_threads (int): Number of threads used by each forward pass, 0 lets ONNX Runtime decide
+        """
+        # Only needed by models using the onnx backend
+        import onnxruntime
+
+        self.path = path
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(path, options, providers = ["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        if isinstance(batch, torch.Tensor):
+            batch = batch.detach().cpu().numpy()
+        output = self.session.run(None, {self.input_name: np.ascontiguousarray(batch)})[0]
+        return torch.from_numpy(output)
+
+    def fingerprint(self):
+        """Returns a hash of the exported graph"""
+        with open(self.path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+def export_onnx(module, example, path):
+    """Exports a module to an ONNX file at path, with a dynamic batch dimension"""
+    module.eval()
+    with torch.no_grad():
+        torch.onnx.export(module, (example,), path, input_names = ["input"], output_names = ["embedding"],
+            dynamic_axes = {"input": {0: "batch"}, "embedding": {0: "batch"}})
@@ -0,0 +1,87 @@
+import threading
+import torch
+
+class QueryGroup():
+    def __init__(self):
+        """Queries waiting to be embedded together"""
+        self.queries = []
+        self.full = threading.Event()
+
+class Query():
+    def __init__(self, tensor, index_name, n):
+        """A single query of a QueryGroup, holds its result once the group ran"""
+        self.tensor = tensor
+        self.index_name = index_name
+        self.n = n
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MicroBatcher():
+    def __init__(self, engine, window = 0.005, max_batch_size = 32):
+        """
+        Groups concurrent single-target searches that use the same model and modality into one batch
+
+        The first query of a group waits up to window seconds, or until max_batch_size queries joined it,
+        then embeds the whole group in one forward pass and runs one search per index for every query
+
+        Parameters:
+        engine (SearchEngine): SearchEngine instance that searches are run on
+        window (float): Seconds the first query of a group waits for others
+        max_batch_size (int): Maximum number of queries embedded together
+        """
+        self.engine = engine
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    def search(self, tensor, tensor_modality, index_name, n = 5, preprocessing = True):
+        """
+        Searches index for the nearest n neighbors of one tensor, see SearchEngine.search
+
+        Returns:
+        arraylike, arraylike: Distances and indices of the results
+        """
+        model_name = self.engine.indexes[index_name].model_name
+        key = (model_name, tensor_modality, preprocessing, tuple(tensor.shape))
+        query = Query(tensor, index_name, n)
+        with self.lock:
+            if key not in self.groups:
+                self.groups[key] = QueryGroup()
+            group = self.groups[key]
+            group.queries.append(query)
+            leader = len(group.queries) == 1
+            if len(group.queries) >= self.max_batch_size:
+                # Later queries start a new group
+                del self.groups[key]
+                group.full.set()
+
+        if leader:
+            group.full.wait(self.window)
+            with self.lock:
+                if self.groups.get(key) is group:
+                    del self.groups[key]
+            self.run(group.queries, tensor_modality, model_name, preprocessing)
+        query.done.wait()
+        if query.error is not None:
+            raise query.error
+        return query.result
+
+    def run(self, queries, tensor_modality, model_name, preprocessing):
+        """Embeds queries in one batch, searches each index once and hands every query its own results"""
+        try:
+            batch = torch.stack([torch.as_tensor(query.tensor) for query in queries])
+            embeddings, _ = self.engine.embed(batch, tensor_modality, model_name, preprocessing = preprocessing)
+            for index_name in set(query.index_name for query in queries):
+                rows = [i for i, query in enumerate(queries) if query.index_name == index_name]
+                n = max(queries[i].n for i in rows)
+                distances, idxs = self.engine.search_embeddings(embeddings[rows], index_name, n)
+                for row, i in enumerate(rows):
+                    queries[i].result = (distances[row][:queries[i].n], idxs[row][:queries[i].n])
+        except Exception as e:
+            for query in queries:
+                query.error = e
+        finally:
+            for query in queries:
+                query.done.set()
@@ -0,0 +1,243 @@
+import numpy as np
+import os
+import time
+import torch
+import warnings
+
+from dime.index import make_index
+from dime.store import BuildManifest, EmbeddingStore
+from dime.utils import BackgroundWriter, pack_embeddings
+
+class IndexBuilder():
+    def __init__(self, engine, index_params, load_embeddings = True, save_embeddings = True, batch_size = 128, force_add = False,
+            background_save = False, prefetch_factor = 2):
+        """
+        Builds one index from batches of its dataset, see SearchEngine.build_index
+
+        Creating the builder resolves which batches still need embedding (start_index), batches are then
+        handed to add_batch in order, and finish returns the index once it is trained and complete
+
+        Parameters:
+        engine (SearchEngine): SearchEngine instance that the index is built for
+        index_params (dict): See Index.__init__
+        load_embeddings (bool): True if previously extracted embeddings should be used if they exist
+        save_embeddings (bool): True if extracted embeddings should be saved during the build
+        batch_size (int): The size of a batch of data being processed
+        force_add (bool): True if forcefully overwriting any Index with the same name
+        background_save (bool): True if embeddings are saved by a background thread while the model runs
+        prefetch_factor (int): Number of batches waiting to be saved by the background thread
+        """
+        self.engine = engine
+        self.dataset = engine.datasets[index_params["dataset_name"]]
+        self.model = engine.models[index_params["model_name"]]
+        assert self.dataset.modality in self.model.modalities, "Model does not support dataset modality"
+        assert force_add or index_params["name"] not in engine.indexes, "Index with given name already exists"
+        index_params["modality"] = self.dataset.modality
+
+        self.post_processing = ""
+        if "post_processing" in index_params:
+            warnings.warn(f"Index being built is being post processed with {index_params['post_processing']}")
+            self.post_processing = index_params["post_processing"]
+
+        self.index = make_index(engine, index_params)
+        # Freezes the stable ids of the dataset's items, so they keep matching the index if the dataset changes
+        self.dataset.save_items()
+
+        self.save_embeddings = save_embeddings
+        self.batch_size = batch_size
+        self.embedding_dir = self.index.embedding_dir
+        if not os.path.exists(self.embedding_dir) and save_embeddings:
+            os.makedirs(self.embedding_dir)
+        self.store = EmbeddingStore(self.embedding_dir, self.model.output_dim, self.post_processing)
+
+        self.start_time = time.time()
+        engine.vprint("Building {}, {} index".format(self.model.name, self.dataset.name))
+
+        self.num_batches = int(np.ceil(len(self.dataset) / batch_size))
+
+        # Indexes that need training are trained on a sample of the whole dataset, so every batch
+        # is embedded and saved first, and then replayed into the index once it is trained
+        self.deferred = save_embeddings and not self.index.is_trained()
+
+        # Saved embeddings are reused up to the last batch committed to the build manifest, so an interrupted
+        # build resumes from exactly the right item, as long as it was started from the same inputs
+        self.manifest = BuildManifest(self.embedding_dir)
+        inputs = {
+            "batch_size": batch_size,
+            "dataset": self.dataset.fingerprint(),
+            "model": self.model.fingerprint(self.dataset.modality),
+            "threshold": self.index.threshold if self.index.binary else None
+        }
+        saved = 0
+        if load_embeddings and self.manifest.info is not None:
+            keys = ["dataset", "model", "threshold"] + ([] if self.manifest.info["complete"] else ["batch_size"])
+            changed = self.manifest.changed_inputs(inputs, keys)
+            if changed:
+                raise RuntimeError(f"Saved embeddings in '{self.embedding_dir}' were built from different inputs ({', '.join(changed)}), " + \
+                    "build with load_embeddings = False to replace them")
+            saved = self.manifest.info["rows"] if self.manifest.info["complete"] else self.manifest.verified_rows(self.store)
+        elif load_embeddings:
+            # Embeddings saved before build manifests were recorded
+            saved = len(self.store)
+
+        self.start_index = self.num_batches if saved >= len(self.dataset) else saved // batch_size
+        saved = saved if self.start_index == self.num_batches else self.start_index * batch_size
+        if save_embeddings:
+            self.store.truncate(saved)
+            self.store.reserve(len(self.dataset))
+            if self.manifest.info is None or not load_embeddings:
+                self.manifest.start(inputs, rows = saved)
+            else:
+                self.manifest.truncate(saved)
+
+        if saved and not self.deferred:
+            engine.vprint("Loading {} saved embeddings".format(saved))
+            for _, embeddings, ids in engine.load_embeddings(self.embedding_dir, self.model, self.post_processing, packed = self.index.binary,
+                    with_ids = True, stop = saved):
+                self.index.add(embeddings, ids)
+
+        background_save = background_save and save_embeddings and self.start_index < self.num_batches
+        self.writer = BackgroundWriter(self.save, prefetch_factor) if background_save else None
+
+    def save(self, embeddings, ids):
+        """Appends embeddings to the store and commits them to the build manifest"""
+        start = len(self.store)
+        self.store.append(embeddings, ids)
+        self.manifest.commit(self.store, start, len(self.store))
+
+    def add_batch(self, batch_idx, batch, preprocessed = False):
+        """
+        Embeds one batch of the dataset and adds it to the index, batches before start_index are skipped
+
+        Parameters:
+        batch_idx (int): Index of the batch in the dataset
+        batch (arraylike): Batch of the dataset, or the outputs of the model's preprocessor on it
+        preprocessed (bool): True if batch already went through the model's preprocessor
+        """
+        if batch_idx < self.start_index:
+            return
+        embeddings = self.model.get_embedding(batch, self.dataset.modality, preprocessing = not preprocessed)
+        embeddings = embeddings.detach().cpu().numpy()
+        if self.index.binary:
+            embeddings = pack_embeddings(embeddings, self.index.threshold)
+        ids = self.dataset.ids[batch_idx * self.batch_size:batch_idx * self.batch_size + len(embeddings)]
+        if not self.deferred:
+            self.index.add(embeddings, ids)
+
+        if self.writer:
+            self.writer.put(embeddings, ids)
+        elif self.save_embeddings:
+            self.save(embeddings, ids)
+
+    def close(self):
+        """Waits for the background thread to save every batch, re-raising any error it met"""
+        if self.writer:
+            writer, self.writer = self.writer, None
+            writer.close()
+
+    def finish(self):
+        """
+        Completes the build once every batch was added: trains a deferred index and replays the saved embeddings into it
+
+        Returns:
+        Index: The built index, not yet part of the engine
+        """
+        self.close()
+        if self.save_embeddings:
+            self.manifest.finish()
+
+        if self.deferred:
+            self.engine.vprint("Training {} index on {} sampled embeddings".format(self.index.index_type, self.index.train_size))
+            self.index.train(self.engine.sample_embeddings(self.embedding_dir, self.model, self.post_processing, self.index.train_size,
+                packed = self.index.binary))
+            self.engine.vprint("Adding {} saved embeddings".format(len(self.store)))
+            for _, embeddings, ids in self.engine.load_embeddings(self.embedding_dir, self.model, self.post_processing, packed = self.index.binary,
+                    with_ids = True):
+                self.index.add(embeddings, ids)
+        self.index.flush()
+
+        time_elapsed = time.time() - self.start_time
+        self.engine.vprint("Finished building index {} in {} seconds.".format(self.index.name, round(time_elapsed, 4)))
+        return self.index
+
+class PreprocessorCache():
+    def __init__(self, engine, backbone, dataset, batch_size, start_index = 0, save = True):
+        """
+        Outputs of a preprocessor model on the batches of a dataset, cached in the preprocessor's embedding store
+        and keyed by item id, see SearchEngine.get_preprocessed_data
+
+        Outputs saved by a complete build of the same preprocessor weights are read back, and only the items missing
+        from them go through the preprocessor. Otherwise every batch goes through it, and its outputs are saved
+        when batches start from the first one and save is True
+
+        Parameters:
+        engine (SearchEngine): SearchEngine instance of the preprocessor model
+        backbone (Model): The preprocessor model
+        dataset (Dataset): Dataset the batches are from
+        batch_size (int): The size of a batch of data being processed
+        start_index (int): The index of the first batch
+        save (bool): False if the store is being written by a build of the preprocessor's own index
+        """
+        self.engine = engine
+        self.backbone = backbone
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.start_index = start_index
+        self.cache_dir = f"{engine.embedding_dir}/{backbone.name}/{dataset.name}/"
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.store = EmbeddingStore(self.cache_dir, backbone.output_dim)
+        self.manifest = BuildManifest(self.cache_dir)
+        inputs = {"batch_size": batch_size, "dataset": dataset.fingerprint(), "model": backbone.fingerprint(dataset.modality), "threshold": None}
+
+        ids = dataset.ids[start_index * batch_size:]
+        # Row of the saved output of each item, -1 if it has to be computed
+        self.rows = np.full(len(ids), -1, dtype = "int64")
+        if self.manifest.info is not None and self.manifest.info["complete"] and not self.manifest.changed_inputs(inputs, ["model"]):
+            cached = ~self.store.missing(ids)
+            if np.any(cached):
+                self.rows[cached] = self.store.find(ids[cached])
+                engine.vprint(f"Reading outputs of preprocessor '{backbone.name}' from '{self.cache_dir}'")
+
+        # The cache is refilled in dataset order, unless it holds embeddings saved without a manifest
+        self.fill = save and start_index == 0 and len(ids) > 0 and np.all(self.rows < 0) and (self.manifest.info is not None or not len(self.store))
+        if self.fill:
+            self.store.truncate(0)
+            self.manifest.start(inputs)
+
+    def complete(self):
+        """Returns True if the outputs of every batch are saved, so batches need not be decoded"""
+        return bool(np.all(self.rows >= 0))
+
+    def get(self, batch_idx, batch = None):
+        """
+        Returns the outputs of the preprocessor on one batch of the dataset
+
+        Parameters:
+        batch_idx (int): Index of the batch in the dataset
+        batch (arraylike): The batch, may be None if every output of it is saved
+        """
+        start = (batch_idx - self.start_index) * self.batch_size
+        rows = self.rows[start:start + self.batch_size]
+        missing = rows < 0
+        if not np.any(missing):
+            outputs = torch.from_numpy(self.store.take(rows))
+            return outputs.cuda() if self.engine.cuda else outputs
+
+        if np.all(missing):
+            outputs = self.backbone.get_embedding(batch, self.dataset.modality).detach()
+        else:
+            computed = self.backbone.get_embedding(batch[torch.from_numpy(np.flatnonzero(missing)).to(batch.device)], self.dataset.modality).detach()
+            outputs = torch.empty((len(rows),) + computed.shape[1:], dtype = computed.dtype, device = computed.device)
+            outputs[torch.from_numpy(missing).to(computed.device)] = computed
+            outputs[torch.from_numpy(~missing).to(computed.device)] = torch.from_numpy(self.store.take(rows[~missing])).to(computed.device)
+        if self.fill:
+            saved = len(self.store)
+            self.store.append(outputs.cpu().numpy(), self.dataset.ids[batch_idx * self.batch_size:batch_idx * self.batch_size + len(outputs)])
+            self.manifest.commit(self.store, saved, len(self.store))
+        return outputs
+
+    def finish(self):
+        """Marks a refilled cache as complete, once every batch went through get"""
+        if self.fill:
+            self.manifest.finish()
@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+def target_identity(target):
+    """
+    Returns a hashable identity for a raw target
+
+    Targets that are files (e.g. uploaded images) include their modification time, so a
+    file that is overwritten under the same name is not served stale results
+    """
+    if isinstance(target, str) and os.path.isfile(target):
+        return (target, os.path.getmtime(target))
+    return target
+
+class ResultCache():
+    def __init__(self, max_size = 1024, ttl = None):
+        """
+        Bounded least-recently-used cache of search results
+
+        Keys are tuples that start with the name of the index searched, so every result of an
+        index can be invalidated when it changes
+
+        Parameters:
+        max_size (int): Maximum number of results held, 0 disables the cache
+        ttl (float): Seconds a result stays valid, None if results never expire
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached result of key, or None on a miss"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, result):
+        """Caches result under key, evicting the least recently used result if full"""
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.time(), result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+
+    def invalidate(self, index_name = None):
+        """Drops every cached result of index_name, or every cached result if index_name is None"""
+        with self.lock:
+            if index_name is None:
+                self.entries.clear()
+                return
+            for key in [k for k in self.entries if k[0] == index_name]:
+                del self.entries[key]
+
+    def get_info(self):
+        """Returns a dictionary of the cache's size and hit/miss counters"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
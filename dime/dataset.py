@@ -1,21 +1,33 @@
+import copy
+import hashlib
+import io
 import numpy as np
 import os
 import pickle
 import PIL
+import torch
 import warnings
-from sklearn.preprocessing import binarize
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
+from torchvision import transforms
 from torchvision.datasets import ImageFolder
 
-from dime.utils import BatchKeySampler
+from dime.decode import draft_size, load_image
+from dime.store import TensorCache, VectorStore
+from dime.tarshards import TarShards, load_tar_index
+from dime.utils import PackedStrings
 
 def load_dataset(engine, dataset_name):
     with open(f"{engine.dataset_dir}/{dataset_name}.dataset.pkl", "rb") as f:
         dataset_params = pickle.load(f)
 
-    if "image" == dataset_params["modality"]:
+    if "image" == dataset_params["modality"] and "tar" == dataset_params.get("source"):
+        return TarImageDataset(engine, dataset_params)
+    elif "image" == dataset_params["modality"]:
         return ImageDataset(engine, dataset_params)
     elif "text" == dataset_params["modality"]:
+        if VectorStore.exists(f"{engine.dataset_dir}/{dataset_name}"):
+            return TextDataset(engine, dataset_params)
+        # Datasets saved before VectorStores hold their data in a pickled dict, which TextDataset moves into a store
         if os.path.isfile(f"{engine.dataset_dir}/{dataset_name}.data.pkl"):
             dataset_params["data_file"] = f"{dataset_name}.data.pkl"
         assert "data" in dataset_params or "data_file" in dataset_params, "Dataset parameters needs to specify data"
@@ -26,6 +38,49 @@ def load_dataset(engine, dataset_name):
     else:
         raise NotImplementedError()
     
+def split_transform(transform):
+    """
+    Splits an image transform at its ToTensor step, so the decoded image can be cached as a uint8 tensor
+
+    Returns:
+    callable: Transform from an image to a uint8 tensor, everything up to ToTensor
+    callable: Transform from a uint8 tensor to the output of transform, everything after ToTensor
+    Returns None, None if transform has no top-level ToTensor step
+    """
+    steps = transform.transforms if isinstance(transform, transforms.Compose) else [transform]
+    positions = [i for i, step in enumerate(steps) if isinstance(step, transforms.ToTensor)]
+    if not positions:
+        return None, None
+    i = positions[0]
+    # ToTensor scales uint8 images by 1/255, exactly like ConvertImageDtype
+    return transforms.Compose(steps[:i] + [transforms.PILToTensor()]), \
+        transforms.Compose([transforms.ConvertImageDtype(torch.float)] + steps[i + 1:])
+
+class ImageFiles(torch.utils.data.Dataset):
+    def __init__(self, filenames, labels, transform = None, size = None):
+        """
+        Images read from their files by position, like an ImageFolder whose samples were already listed
+
+        Parameters:
+        filenames (sequence of str): Filenames of the images
+        labels (arraylike): Class index of each image
+        transform (callable): transforms to apply to images
+        size (tuple): Size JPEGs are decoded at in draft mode, see dime.decode.load_image
+        """
+        self.filenames = filenames
+        self.labels = labels
+        self.transform = transform
+        self.size = size
+
+    def __getitem__(self, position):
+        image = load_image(self.filenames[position], self.size)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, int(self.labels[position])
+
+    def __len__(self):
+        return len(self.filenames)
+
 class Dataset():
     def __init__(self, engine, dataset_params):
         """
@@ -41,25 +96,33 @@ class Dataset():
     def idx_to_target(self, indicies):
         raise NotImplementedError
     
-    def get_data(self, batch_size = 1, start_index = 0):
+    def get_data(self, batch_size = 1, start_index = 0, positions = None, num_workers = 0, prefetch_factor = 2):
         """
         Generator function that returns data
         
         Parameters:
         batch_size: the size that data should be batched in
-        start_index: the index of the first batch to be yielded (will skip earlier batches)
+        start_index: the index of the first batch to be yielded (earlier batches are not loaded)
+        positions: positions of the items to load, all items if None
+        num_workers: number of worker processes decoding items, 0 decodes them in this process
+        prefetch_factor: number of batches each worker decodes ahead
         
         Yields:
         int: Batch index
         arraylike: data in tensor form
         """
-        data_loader = DataLoader(self.data, batch_size = batch_size)
-        for batch_idx, bunch in enumerate(data_loader):
-            if batch_idx >= start_index:
-                batch, _ = bunch
-                if self.engine.cuda:
-                    batch = batch.cuda()
-                yield batch_idx, batch
+        if positions is None:
+            positions = range(len(self.data))
+        data = Subset(self.data, positions[start_index * batch_size:])
+        # Workers hand batches back in order, so batch indices stay aligned with the items
+        # prefetch_factor is only accepted along with worker processes
+        kwargs = {"prefetch_factor": prefetch_factor, "pin_memory": self.engine.cuda} if num_workers > 0 else {}
+        data_loader = DataLoader(data, batch_size = batch_size, num_workers = num_workers, **kwargs)
+        for batch_idx, bunch in enumerate(data_loader, start = start_index):
+            batch, _ = bunch
+            if self.engine.cuda:
+                batch = batch.cuda()
+            yield batch_idx, batch
 
     def __len__(self):
         """Number of datapoints"""
@@ -73,6 +136,33 @@ class Dataset():
         """Create tensor from target as if it came from self.data"""
         raise NotImplementedError()
 
+    def targets_to_batch(self, targets):
+        """Create one batch tensor from a list of targets, see target_to_tensor"""
+        return torch.stack([self.target_to_tensor(target) for target in targets])
+
+    def fingerprint(self):
+        """Returns a hash of the dataset's items and their stable ids, which changes whenever items change"""
+        h = hashlib.sha1(np.asarray(self.ids, dtype = "int64").tobytes())
+        for target in self.idx_to_target([int(i) for i in self.ids]):
+            h.update(f"{target}\n".encode())
+        return h.hexdigest()
+
+    def add_items(self, targets):
+        """Add items to the dataset under new stable ids, see ImageDataset.add_items"""
+        raise NotImplementedError()
+
+    def remove_items(self, targets):
+        """Remove items from the dataset, see ImageDataset.remove_items"""
+        raise NotImplementedError()
+
+    def scan(self):
+        """Returns (new targets, missing targets) of the dataset's source, see ImageDataset.scan"""
+        raise NotImplementedError()
+
+    def save_items(self):
+        """Persists the stable ids of the dataset's items, only needed by datasets that can change"""
+        pass
+
 class ImageDataset(Dataset):
     def __init__(self, engine, dataset_params):
         """Dataset class specific to images
@@ -86,7 +176,15 @@ class ImageDataset(Dataset):
             "modality": (str) modality, should always be "image"
             "dim":      (tuple) dimension of tensors of dataset
             "desc":     (str) A description
+            "tensor_cache": (bool) True if get_data should cache decoded images, see get_data (default False)
+            "draft":    (bool) True if JPEGs should be decoded at a reduced scale when transform starts with a Resize,
+                        see dime.decode.load_image (default False). Changes the tensors slightly, so rebuild indexes after changing it
         }
+
+        Every image has a stable id that is kept when other images are added or removed, the ids
+        are saved to <dataset_dir>/<name>.items.pkl and default to the position of the image.
+        The paths, labels and modification times of the images are saved along with them, and
+        loaded instead of walking data_dir when the dataset is loaded again
         """
         self.engine = engine
         self.params = dataset_params
@@ -100,95 +198,389 @@ class ImageDataset(Dataset):
         self.dim = tuple(dataset_params["dim"])
         self.desc = dataset_params["desc"]
 
-        self.data = ImageFolder(
-            f"{self.engine.dataset_dir}/{self.data_dir}", 
-            transform=self.transform)
-        self.filenames = []
-        self.labels = []
-        for filename, label in self.data.samples:
-            self.filenames.append(os.path.normpath(filename))
-            self.labels.append(label)
-        
+        self.root = os.path.normpath(f"{self.engine.dataset_dir}/{self.data_dir}")
+        self.items_file = f"{self.engine.dataset_dir}/{self.name}.items.pkl"
+
+        self.draft_size = draft_size(self.transform) if dataset_params.get("draft") else None
+        # Images are decoded by the engine's decode pool when it has one and the transform can be sent to its workers
+        self.pooled = engine.decode_pool is not None
+        if self.pooled:
+            try:
+                pickle.dumps(self.transform)
+            except Exception:
+                warnings.warn(f"Transform of dataset '{self.name}' cannot be sent to decode workers, its images are decoded in this process")
+                self.pooled = False
+
+        self.decode_transform, self.tensor_transform = None, None
+        if dataset_params.get("tensor_cache"):
+            self.decode_transform, self.tensor_transform = split_transform(self.transform)
+            if self.decode_transform is None:
+                warnings.warn(f"Dataset '{self.name}' has no ToTensor transform step, its images are not cached")
+
+        # The manifest of the images is read from items_file when it exists, the directory tree is only walked without it
+        if os.path.isfile(self.items_file):
+            with open(self.items_file, "rb") as f:
+                items = pickle.load(f)
+            if "filenames" in items:
+                # Manifests saved before paths were packed, without classes or modification times
+                classes = {}
+                for filename, label in zip(items["filenames"], items["labels"]):
+                    classes.setdefault(label, filename.split(os.sep)[0])
+                items["classes"] = [classes.get(i, "") for i in range(max(classes, default = -1) + 1)]
+                items["paths"] = PackedStrings.pack(items["filenames"])
+                items["mtimes"] = np.full(len(items["filenames"]), np.nan)
+            else:
+                items["paths"] = PackedStrings(items["paths"], items["offsets"])
+            self.classes = items["classes"]
+            self.set_items(items["paths"], items["labels"], items["mtimes"])
+            self.ids = items["ids"]
+            self.next_id = items["next_id"]
+        else:
+            folder = ImageFolder(self.root)
+            self.classes = folder.classes
+            filenames = [os.path.normpath(filename) for filename, _ in folder.samples]
+            self.set_items(PackedStrings.pack([os.path.relpath(filename, self.root) for filename in filenames]),
+                folder.targets, [os.path.getmtime(filename) for filename in filenames])
+            self.ids = np.arange(len(self.filenames), dtype="int64")
+            self.next_id = len(self.filenames)
+
+    def set_items(self, paths, labels, mtimes):
+        """
+        Sets the images of the dataset, in order of their stable ids
+
+        Parameters:
+        paths (PackedStrings): Paths of the images relative to root
+        labels (arraylike): Index in self.classes of the class of each image
+        mtimes (arraylike): Modification time of each image when it was added, NaN if unknown
+        """
+        self.filenames = PackedStrings(paths.buffer, paths.offsets, prefix = self.root + os.sep)
+        self.labels = np.asarray(labels, dtype="int64")
+        self.mtimes = np.asarray(mtimes, dtype="float64")
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.data = ImageFiles(self.filenames, self.labels, transform = self.transform, size = self.draft_size)
+
+    def tensor_cache(self):
+        """
+        Returns the TensorCache of the dataset's decoded images, or None if images are not cached
+
+        The cache lives in <dataset_dir>/<name>.tensors/<fingerprint of the decoding transform and draft size>/, so changing
+        either starts a new cache, and items are looked up by stable id, so adding images only decodes the new ones
+        """
+        if self.decode_transform is None:
+            return None
+        decoding = f"{self.decode_transform}\n{self.dim}"
+        if self.draft_size is not None:
+            # Draft decoding changes the decoded images, full scale caches keep their fingerprint
+            decoding += f"\n{self.draft_size}"
+        fingerprint = hashlib.sha1(decoding.encode()).hexdigest()
+        cache_dir = f"{self.engine.dataset_dir}/{self.name}.tensors/{fingerprint}"
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        return TensorCache(cache_dir, self.dim)
+
+    def get_data(self, batch_size = 1, start_index = 0, positions = None, num_workers = 0, prefetch_factor = 2):
+        """
+        Generator function that returns data, see Dataset.get_data
+
+        With a tensor cache, images missing from the cache are decoded and added to it first,
+        then every batch is read from the cache and only goes through the steps of transform after ToTensor
+        """
+        cache = self.tensor_cache()
+        if cache is None and self.pooled and not num_workers:
+            yield from self.get_pooled_data(batch_size, start_index = start_index, positions = positions, prefetch_factor = prefetch_factor)
+            return
+        if cache is None:
+            yield from super().get_data(batch_size, start_index = start_index, positions = positions,
+                num_workers = num_workers, prefetch_factor = prefetch_factor)
+            return
+
+        if positions is None:
+            positions = range(len(self.data))
+        positions = np.asarray(positions, dtype = "int64")[start_index * batch_size:]
+        ids = self.ids[positions]
+        if not len(ids):
+            return
+        missing = positions[cache.missing(ids)]
+        if len(missing):
+            self.engine.vprint(f"Caching {len(missing)} decoded images of dataset '{self.name}'")
+            data = copy.copy(self.data)
+            data.transform = self.decode_transform
+            kwargs = {"prefetch_factor": prefetch_factor} if num_workers > 0 else {}
+            data_loader = DataLoader(Subset(data, missing), batch_size = batch_size, num_workers = num_workers, **kwargs)
+            for batch_idx, (batch, _) in enumerate(data_loader):
+                cache.append(batch.numpy(), self.ids[missing[batch_idx * batch_size:batch_idx * batch_size + len(batch)]])
+
+        rows = cache.find(ids)
+        for batch_idx, start in enumerate(range(0, len(rows), batch_size), start = start_index):
+            batch = torch.from_numpy(cache.take(rows[start:start + batch_size]))
+            batch = torch.stack([self.tensor_transform(tensor) for tensor in batch])
+            if self.engine.cuda:
+                batch = batch.cuda()
+            yield batch_idx, batch
+
+    def get_pooled_data(self, batch_size = 1, start_index = 0, positions = None, prefetch_factor = 2):
+        """
+        Generator function that returns data decoded by the engine's decode pool, see Dataset.get_data
+
+        Up to prefetch_factor batches are decoded ahead of the batch being yielded
+        """
+        positions = np.arange(len(self.filenames)) if positions is None else np.asarray(positions, dtype = "int64")
+        starts = range(start_index * batch_size, len(positions), batch_size)
+        def submit(start):
+            return self.engine.decode_pool.submit([self.filenames[p] for p in positions[start:start + batch_size]], self.transform, self.draft_size)
+        pending = [submit(start) for start in starts[:prefetch_factor]]
+        for i, start in enumerate(starts):
+            if i + prefetch_factor < len(starts):
+                pending.append(submit(starts[i + prefetch_factor]))
+            batch = self.engine.decode_pool.gather(pending.pop(0))
+            if self.engine.cuda:
+                batch = batch.cuda()
+            yield start_index + i, batch
+
     def idx_to_target(self, indicies):
         """
         Takes either an int or a list of ints and returns corresponding filenames of images
 
         Parameters:
-        indices (int or list of ints): Indices of interest
+        indices (int or list of ints): Stable ids of interest
 
         Returns:
         list: list of filenames corresponding to provided indicies
         """
+        positions = np.minimum(np.searchsorted(self.ids, indicies), max(len(self.ids) - 1, 0))
+        if not len(self.ids) or np.any(self.ids[positions] != indicies):
+            unknown = np.setdiff1d(indicies, self.ids)
+            raise RuntimeError(f"Ids {unknown.tolist()} are not items of dataset '{self.name}', they may have been removed")
         if type(indicies) == int:
-            return self.filenames[indicies]
-        return [self.filenames[i] for i in indicies]
+            return self.filenames[positions]
+        return [self.filenames[i] for i in positions]
+
+    def fingerprint(self):
+        """Returns a hash of the dataset's items and their stable ids, see Dataset.fingerprint, hashed from the packed paths at once"""
+        h = hashlib.sha1(np.asarray(self.ids, dtype = "int64").tobytes())
+        h.update(self.filenames.prefix.encode())
+        h.update(self.filenames.offsets.tobytes())
+        h.update(self.filenames.buffer.tobytes())
+        return h.hexdigest()
+
+    def scan(self):
+        """
+        Crawls data_dir for images that were added, deleted or modified since they were added to the dataset
+
+        Returns:
+        list: filenames of images not in the dataset, or modified since they were added
+        list: filenames of images in the dataset that no longer exist, or were modified since they were added
+        """
+        found = [os.path.normpath(filename) for filename, _ in ImageFolder(self.root).samples]
+        known = set(self.filenames)
+        new = [filename for filename in found if filename not in known]
+        found = set(found)
+        missing, modified = [], []
+        for filename, mtime in zip(self.filenames, self.mtimes):
+            if filename not in found:
+                missing.append(filename)
+            elif not np.isnan(mtime) and os.path.getmtime(filename) != mtime:
+                modified.append(filename)
+        # Modified images are removed and added back under new ids, see SearchEngine.sync_dataset
+        return new + modified, missing + modified
+
+    def add_items(self, targets):
+        """
+        Appends images to the dataset under new stable ids
+
+        Parameters:
+        targets (list of str): Filenames of images inside data_dir
+
+        Returns:
+        arraylike: Positions of the new images, see Dataset.get_data
+        arraylike: Stable ids of the new images
+        """
+        positions = np.arange(len(self.filenames), len(self.filenames) + len(targets))
+        ids = np.arange(self.next_id, self.next_id + len(targets), dtype="int64")
+        targets = [os.path.normpath(target) for target in targets]
+        labels = []
+        for target in targets:
+            class_name = os.path.basename(os.path.dirname(target))
+            if class_name not in self.class_to_idx:
+                self.class_to_idx[class_name] = len(self.classes)
+                self.classes.append(class_name)
+            labels.append(self.class_to_idx[class_name])
+        paths = self.filenames.extend([os.path.relpath(target, self.root) for target in targets])
+        self.set_items(paths, np.concatenate([self.labels, labels]), np.concatenate([self.mtimes, [os.path.getmtime(t) for t in targets]]))
+        self.ids = np.concatenate([self.ids, ids])
+        self.next_id += len(targets)
+        self.save_items()
+        return positions, ids
+
+    def remove_items(self, targets):
+        """
+        Removes images from the dataset, the ids of the remaining images do not change
+
+        Parameters:
+        targets (list of str): Filenames of images in the dataset
+
+        Returns:
+        arraylike: Stable ids of the removed images
+        """
+        positions = self.filenames.find([os.path.normpath(target) for target in targets])
+        removed_ids = self.ids[positions[positions >= 0]]
+        keep = ~np.isin(self.ids, removed_ids)
+        self.set_items(self.filenames.take(keep), self.labels[keep], self.mtimes[keep])
+        self.ids = self.ids[keep]
+        self.save_items()
+        return removed_ids
+
+    def save_items(self):
+        """Saves the manifest of the images (packed paths relative to root, labels, modification times) and their stable ids to items_file"""
+        items = {
+            "paths": self.filenames.buffer,
+            "offsets": self.filenames.offsets,
+            "labels": self.labels,
+            "classes": self.classes,
+            "mtimes": self.mtimes,
+            "ids": self.ids,
+            "next_id": self.next_id
+        }
+        with open(self.items_file, "wb+") as f:
+            pickle.dump(items, f)
 
     def target_to_tensor(self, target):
         """Create tensor from target as if it came from self.data"""
-        image = PIL.Image.open(target)
-        return self.transform(image)
+        if self.pooled:
+            return self.engine.decode_pool.decode([target], self.transform, self.draft_size)[0]
+        return self.transform(load_image(target, self.draft_size))
+
+    def targets_to_batch(self, targets):
+        """Create one batch tensor from a list of targets, decoded in parallel by the engine's decode pool if it has one"""
+        if self.pooled:
+            return self.engine.decode_pool.decode(targets, self.transform, self.draft_size)
+        return super().targets_to_batch(targets)
 
     def save(self, save_data = False):
         """Save the dataset"""
         info = self.params
         with open(f"{self.engine.dataset_dir}/{self.name}.dataset.pkl", "wb+") as f:
             pickle.dump(info, f)
+        self.save_items()
+
+class TarImageDataset(Dataset):
+    def __init__(self, engine, dataset_params):
+        """Dataset class for images stored in tar shards, see dime.tarshards
+
+        Parameters:
+        engine (SearchEngine): SearchEngine instance that model is part of
+        dataset_params (dict): {
+            "name":     (str) Name of dataset
+            "data_dir": (str) Path to directory of tar shards, e.g. written by dime.tarshards.convert_image_folder
+            "source":   (str) Should always be "tar"
+            "transform":(callable) transforms to apply to images
+            "modality": (str) modality, should always be "image"
+            "dim":      (tuple) dimension of tensors of dataset
+            "desc":     (str) A description
+        }
+
+        Images are read by offset from the shards, so batches of contiguous items are read sequentially.
+        Each image is named <dataset_dir>/<data_dir>/<path inside its shard>, as if the shards were extracted
+        in data_dir, and read_target resolves those names. Ids are the positions of the images in the shards
+        """
+        self.engine = engine
+        self.params = dataset_params
+
+        assert dataset_params["modality"] == "image", "TarImageDataset received unexpected modality"
+
+        self.name = dataset_params["name"]
+        self.data_dir = os.path.normpath(dataset_params["data_dir"])
+        self.transform = dataset_params["transform"]
+        self.modality = dataset_params["modality"]
+        self.dim = tuple(dataset_params["dim"])
+        self.desc = dataset_params["desc"]
+
+        self.root = os.path.normpath(f"{self.engine.dataset_dir}/{self.data_dir}")
+        self.data = TarShards(self.root, load_tar_index(self.root), transform = self.transform)
+        self.filenames = [os.path.normpath(os.path.join(self.root, name)) for name in self.data.names]
+        self.positions = {filename: i for i, filename in enumerate(self.filenames)}
+        self.ids = np.arange(len(self.filenames), dtype="int64")
+
+    def idx_to_target(self, indicies):
+        """
+        Takes either an int or a list of ints and returns corresponding names of images, see ImageDataset.idx_to_target
+        """
+        if type(indicies) == int:
+            return self.filenames[indicies]
+        return [self.filenames[i] for i in indicies]
+
+    def read_target(self, target):
+        """Returns the bytes of the image named target, or None if target is not in the shards"""
+        position = self.positions.get(os.path.normpath(target))
+        if position is None:
+            return None
+        return self.data.read(position)
+
+    def target_to_tensor(self, target):
+        """Create tensor from target as if it came from self.data, target is either an image of the shards or an image file"""
+        data = self.read_target(target)
+        image = PIL.Image.open(io.BytesIO(data) if data is not None else target).convert("RGB")
+        return self.transform(image)
+
+    def save(self, save_data = False):
+        """Save the dataset"""
+        with open(f"{self.engine.dataset_dir}/{self.name}.dataset.pkl", "wb+") as f:
+            pickle.dump(self.params, f)
 
 class TextDataset(Dataset):
-    #TODO: memory optimuize this class
     def __init__(self, engine, dataset_params):
-        """Dataset class specific to images
-        
+        """Dataset class specific to text
+
         Parameters:
         engine (SearchEngine): SearchEngine instance that model is part of
         dataset_params (dict): {
             "name":     (str) Name of dataset
-            "data":     (dict) Mapping of strings to tensors, can specify data_path instead
+            "data":     (dict) Mapping of strings to tensors, not needed once the dataset was added
             "modality": (str) modality, should always be "text"
             "dim":      (tuple) dimension of tensors of dataset
             "desc":     (str) A description
         }
+
+        The strings and their tensors are kept in a VectorStore at <dataset_dir>/<name>.*.store, written from
+        "data" when it is given or by dime.vectors.ingest_vectors, and every item is read back from the memory-mapped store
         """
         self.engine = engine
-        self.params = dataset_params
 
         assert dataset_params["modality"] == "text", "TextDataset received unexpected modality"
 
         self.name = dataset_params["name"]
-        self.data = dataset_params["data"]
         self.modality = dataset_params["modality"]
         self.dim = dataset_params["dim"]
         self.desc = dataset_params["desc"]
 
-        self.targets = list(self.data.keys())
+        self.data = VectorStore(f"{self.engine.dataset_dir}/{self.name}", self.dim)
+        if "data" in dataset_params:
+            self.data.truncate(0)
+            keys = list(dataset_params["data"].keys())
+            for start in range(0, len(keys), 65536):
+                chunk = keys[start:start + 65536]
+                self.data.append(chunk, np.stack([np.asarray(dataset_params["data"][k], dtype = "float32") for k in chunk]))
+            self.data.finish()
+        self.params = {k: v for k, v in dataset_params.items() if k not in ("data", "data_file")}
+
+        self.ids = np.arange(len(self.data), dtype="int64")
 
     def save(self, save_data = False):
-        """Save the dataset"""
+        """Save the dataset, its strings and tensors are always saved in its VectorStore"""
         info = {
             "name": self.name,
             "modality": self.modality,
             "dim": self.dim,
             "desc": self.desc
         }
-        if "data_file" in self.params:
-            info["data_file"] = self.params["data_file"]
-
-        if save_data:
-            data_file = f"{self.name}.data.pkl"
-            with open(f"{self.engine.dataset_dir}/{data_file}", "wb+") as f:
-                pickle.dump(self.data, f)
-            info["data_file"] = data_file
-
-        if "data_file" not in info:
-            warnings.warn(f"TextDataset {self.name} parameters being saved without saved data")
-
         with open(f"{self.engine.dataset_dir}/{self.name}.dataset.pkl", "wb+") as f:
             pickle.dump(info, f)
     
     def target_to_tensor(self, target):
         """Create tensor from target as if it came from self.data"""
-        assert target in self.data, "Target '{target}' does not exist in '{self}'"
-        return self.data[target]
+        row = self.data.row(target)
+        assert row >= 0, f"Target '{target}' does not exist in '{self.name}'"
+        return torch.from_numpy(np.array(self.data.vectors[row]))
 
     def idx_to_target(self, indicies):
         """
@@ -201,18 +593,22 @@ class TextDataset(Dataset):
         list: list of targets corresponding to provided indicies
         """
         if type(indicies) == int:
-            return self.targets[indicies]
-        return [self.targets[i] for i in indicies]
+            return self.data.key(indicies)
+        return [self.data.key(int(i)) for i in indicies]
 
-    def get_data(self, batch_size = 1, start_index = 0):
+    def get_data(self, batch_size = 1, start_index = 0, positions = None, num_workers = 0, prefetch_factor = 2):
         """
-        Generator function that returns data
+        Generator function that returns data, see Dataset.get_data
+
+        Batches are sliced from the memory-mapped vectors, so no worker processes are used
         """
-        sampler = BatchKeySampler(self.data, batch_size)
-        data_loader = DataLoader(self.data, batch_sampler = sampler)
-        for batch_idx, batch in enumerate(data_loader):
-            if batch_idx >= start_index:
-                if self.engine.cuda:
-                    batch = batch.cuda()
-                yield batch_idx, batch
-    
\ No newline at end of file
+        positions = np.arange(len(self.data)) if positions is None else np.asarray(positions, dtype = "int64")
+        for batch_idx, start in enumerate(range(start_index * batch_size, len(positions), batch_size), start = start_index):
+            rows = positions[start:start + batch_size]
+            if len(rows) and rows[-1] - rows[0] == len(rows) - 1:
+                batch = torch.from_numpy(np.array(self.data.vectors[rows[0]:rows[-1] + 1]))
+            else:
+                batch = torch.from_numpy(self.data.vectors[rows])
+            if self.engine.cuda:
+                batch = batch.cuda()
+            yield batch_idx, batch
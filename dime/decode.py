@@ -0,0 +1,74 @@
+import multiprocessing
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from torchvision import transforms
+
+def draft_size(transform):
+    """
+    Returns the smallest (width, height) an image can be decoded at without changing the output of transform,
+    None if transform does not start by resizing the image to a fixed size
+
+    A Resize to an int size scales the shorter side to it, so both sides are kept at least that large
+    """
+    steps = transform.transforms if isinstance(transform, transforms.Compose) else [transform]
+    if not steps or not isinstance(steps[0], transforms.Resize):
+        return None
+    size = steps[0].size
+    if isinstance(size, int):
+        return (size, size)
+    if len(size) == 1:
+        return (size[0], size[0])
+    return (size[1], size[0])
+
+def load_image(path, size = None):
+    """
+    Opens an image as RGB, like ImageFolder's default loader
+
+    JPEGs are decoded at the smallest scale (1/2, 1/4 or 1/8) that is still at least size, using PIL's draft mode,
+    which skips most of the decoding work of large photos that are resized right after
+
+    Parameters:
+    path (str or file): Image to open
+    size (tuple): (width, height) the image is resized to after decoding, see draft_size, None decodes at full scale
+    """
+    image = Image.open(path)
+    if size is not None and "JPEG" == image.format:
+        image.draft("RGB", size)
+    return image.convert("RGB")
+
+def decode_images(filenames, transform, size = None):
+    """Returns the images at filenames, each loaded by load_image and transformed, as one numpy array"""
+    return np.stack([np.asarray(transform(load_image(filename, size))) for filename in filenames])
+
+class DecodePool():
+    def __init__(self, num_workers):
+        """
+        Pool of worker processes decoding and transforming images, shared by every dataset of a SearchEngine
+
+        Every call splits its images into one task per worker, so a single query or batch uses the whole pool.
+        Workers start on first use, and are spawned rather than forked like the workers of ShardedIndex
+
+        Parameters:
+        num_workers (int): Number of worker processes
+        """
+        self.num_workers = num_workers
+        self.executor = ProcessPoolExecutor(num_workers, mp_context = multiprocessing.get_context("spawn"))
+
+    def submit(self, filenames, transform, size = None):
+        """Starts decoding images, returns futures to be passed to gather"""
+        chunk_size = max(1, int(np.ceil(len(filenames) / self.num_workers)))
+        return [self.executor.submit(decode_images, filenames[i:i + chunk_size], transform, size)
+            for i in range(0, len(filenames), chunk_size)]
+
+    def gather(self, futures):
+        """Returns the images of submit as one batch tensor"""
+        return torch.from_numpy(np.concatenate([future.result() for future in futures]))
+
+    def decode(self, filenames, transform, size = None):
+        """Returns the images at filenames, decoded and transformed by the pool, as one batch tensor"""
+        return self.gather(self.submit(list(filenames), transform, size))
+
+    def close(self):
+        self.executor.shutdown()
@@ -2,14 +2,19 @@ import numpy as np
 import os
 import time
 import json
-import random
-from sklearn.preprocessing import binarize
+import threading
 import warnings
-
-from dime.dataset import Dataset, ImageDataset, TextDataset, load_dataset
-from dime.index import Index, load_index
+from concurrent.futures import ThreadPoolExecutor
+
+from dime.batcher import MicroBatcher
+from dime.builder import IndexBuilder, PreprocessorCache
+from dime.cache import ResultCache, target_identity
+from dime.dataset import Dataset, ImageDataset, TarImageDataset, TextDataset, load_dataset
+from dime.decode import DecodePool
+from dime.index import load_index
 from dime.model import Model, load_model
-from dime.utils import load_batch, save_batch
+from dime.store import BuildManifest, EmbeddingStore
+from dime.utils import LazyDict, load_removed_ids, pack_embeddings, save_removed_ids
 
 def load_engine(engine_path):
     start_time = time.time()
@@ -34,6 +39,14 @@ class SearchEngine():
             "model_dir":        (str) Directory of Models
             "embedding_dir":    (str) Directory of embeddings
             "modalities":       (list of str) The modalities support by this instance
+            "cache_size":       (int) Number of search results to cache, 0 disables the cache (default 1024)
+            "cache_ttl":        (float) Seconds a cached search result stays valid, None if results never expire (default None)
+            "lazy":             (bool) True if datasets, models and indexes are loaded on first access instead of at startup
+            "prefetch":         (list of str) Indexes loaded in the background at startup when lazy, along with their models and datasets
+            "batch_window":     (float) Seconds concurrent queries wait to be embedded and searched together, 0 disables micro-batching (default 0)
+            "max_batch_size":   (int) Maximum number of queries embedded together (default 32)
+            "search_threads":   (int) Number of threads searching indexes in parallel in search_indexes (default 8)
+            "decode_workers":   (int) Number of processes decoding images for queries and builds, 0 decodes them in this process (default 0)
         }
         """
         self.params = engine_params
@@ -46,10 +59,20 @@ class SearchEngine():
         self.index_dir = engine_params["index_dir"]
         self.model_dir = engine_params["model_dir"]
         self.embedding_dir = engine_params["embedding_dir"]
+
+        self.cache = ResultCache(engine_params.get("cache_size", 1024), engine_params.get("cache_ttl", None))
+        self.batcher = None
+        if engine_params.get("batch_window", 0) > 0:
+            self.batcher = MicroBatcher(self, engine_params["batch_window"], engine_params.get("max_batch_size", 32))
+        self.search_pool = ThreadPoolExecutor(engine_params.get("search_threads", 8))
+        self.decode_pool = None
+        if engine_params.get("decode_workers", 0) > 0:
+            self.decode_pool = DecodePool(engine_params["decode_workers"])
         
-        self.indexes = {}
-        self.models = {}
-        self.datasets = {}
+        self.indexes = LazyDict(lambda name: self.load_asset("index", name))
+        self.models = LazyDict(lambda name: self.load_asset("model", name))
+        self.datasets = LazyDict(lambda name: self.load_asset("dataset", name))
+        self.index_model_names = {}
         self.modalities = {}
 
         self.modalities = {m: {
@@ -58,35 +81,74 @@ class SearchEngine():
             "model_names":[], 
             } for m in engine_params["modalities"] }
         
-        if "modality_dicts" in engine_params:
+        if "modality_dicts" in engine_params and engine_params.get("lazy", False):
+            # Only record names, every asset is loaded on first access
             for modality in self.modalities:
                 modality_dict = engine_params["modality_dicts"][modality]
                 for dataset_name in modality_dict["dataset_names"]:
-
-                    self.vprint(f"Loading dataset '{dataset_name}'... ", end = "")
-                    start_time = time.time()
-                    dataset = load_dataset(self, dataset_name)
+                    self.datasets.defer(dataset_name)
+                    self.modalities[modality]["dataset_names"].append(dataset_name)
+                for model_name in modality_dict["model_names"]:
+                    self.models.defer(model_name)
+                    if model_name not in self.modalities[modality]["model_names"]:
+                        self.modalities[modality]["model_names"].append(model_name)
+                for index_name in modality_dict["index_names"]:
+                    with open(f"{self.index_dir}/{index_name}.index", "r") as f:
+                        self.index_model_names[index_name] = json.loads(f.read())["model_name"]
+                    self.indexes.defer(index_name)
+                    self.modalities[modality]["index_names"].append(index_name)
+            if engine_params.get("prefetch"):
+                threading.Thread(target = self.prefetch, args = (engine_params["prefetch"],), daemon = True).start()
+        elif "modality_dicts" in engine_params:
+            for modality in self.modalities:
+                modality_dict = engine_params["modality_dicts"][modality]
+                for dataset_name in modality_dict["dataset_names"]:
+                    dataset = self.load_asset("dataset", dataset_name)
                     self.datasets[dataset.name] = dataset
                     self.modalities[dataset.modality]["dataset_names"].append(dataset.name)
-                    self.vprint(f"done in {round(time.time() - start_time, 4)} seconds!")
 
                 for model_name in modality_dict["model_names"]:
                     if model_name not in self.models:
-                        self.vprint(f"Loading model '{model_name}'... ", end = "")
-                        start_time = time.time()
-                        model = load_model(self, model_name)
+                        model = self.load_asset("model", model_name)
                         self.models[model.name] = model
                         for model_modality in model.modalities:
                             self.modalities[model_modality]["model_names"].append(model.name)
-                        self.vprint(f"done in {round(time.time() - start_time, 4)} seconds!")
                             
                 for index_name in modality_dict["index_names"]:
-                    self.vprint(f"Loading index '{index_name}'... ", end = "")
-                    start_time = time.time()
-                    index = load_index(self, index_name)
+                    index = self.load_asset("index", index_name)
                     self.indexes[index.name] = index
+                    self.index_model_names[index.name] = index.model_name
                     self.modalities[index.modality]["index_names"].append(index.name)
-                    self.vprint(f"done in {round(time.time() - start_time, 4)} seconds!")
+
+    def load_asset(self, kind, name):
+        """
+        Loads a saved dataset, model or index
+
+        Parameters:
+        kind (str): "dataset", "model" or "index"
+        name (str): Name of the asset
+
+        Returns:
+        Dataset, Model or Index: The loaded asset
+        """
+        loaders = {"dataset": load_dataset, "model": load_model, "index": load_index}
+        self.vprint(f"Loading {kind} '{name}'... ", end = "")
+        start_time = time.time()
+        asset = loaders[kind](self, name)
+        self.vprint(f"done in {round(time.time() - start_time, 4)} seconds!")
+        return asset
+
+    def prefetch(self, index_names):
+        """
+        Loads indexes along with their models and datasets, used to warm up a lazily loaded engine
+
+        Parameters:
+        index_names (list of str): Names of the indexes to load
+        """
+        for index_name in index_names:
+            index = self.indexes[index_name]
+            self.models[index.model_name]
+            self.datasets[index.dataset_name]
 
     def valid_index_names(self, modality, tensor = None):
         """
@@ -100,24 +162,45 @@ class SearchEngine():
         list of tuples: Keys of valid indexes
         """
         if tensor is not None:
-            valid_model_names = [m.name for m in list(self.models.values()) if m.can_call(modality, tensor.shape)]
-            valid = [i.name for i in list(self.indexes.values()) if i.model_name in valid_model_names]
+            valid_model_names = [m for m in self.modalities[modality]["model_names"] if self.models[m].can_call(modality, tensor.shape)]
         else:
-            valid = [i.name for i in list(self.indexes.values()) if modality in i.input_modalities]
-        return valid
+            valid_model_names = self.modalities[modality]["model_names"]
+        return [i for i, m in self.index_model_names.items() if m in valid_model_names]
+
+    def buildable_indexes(self, missing = False):
+        """
+        Returns (model, dataset) pairs that are compatible
 
-    def buildable_indexes(self):
-        """Returns (model, dataset) pairs that are compatible"""
-        pass
-        #TODO: Write this functiont"
+        Parameters:
+        missing (bool): True if only pairs without any index should be returned
+
+        Returns:
+        list of (str, str): Model and dataset names
+        """
+        built = set()
+        if missing:
+            for index_name, model_name in self.index_model_names.items():
+                if index_name in self.indexes.loaded():
+                    dataset_name = self.indexes[index_name].dataset_name
+                else:
+                    # Lazily loaded indexes are not read just to learn their dataset
+                    with open(f"{self.index_dir}/{index_name}.index", "r") as f:
+                        dataset_name = json.loads(f.read())["dataset_name"]
+                built.add((model_name, dataset_name))
+        pairs = []
+        for model_name, model in self.models.items():
+            for dataset_name, dataset in self.datasets.items():
+                if dataset.modality in model.modalities and (model_name, dataset_name) not in built:
+                    pairs.append((model_name, dataset_name))
+        return pairs
     
     def get_embedding(self, model_name, batch, modality, preprocessing = True):
         model = self.models[model_name]
         if self.cuda:
             batch = batch.cuda()
-        embeddings = model.get_embedding(batch, modality, preprocessing = preprocessing)
+        embeddings = model.get_embedding(batch, modality, preprocessing = preprocessing).detach()
         if self.cuda:
-            embeddings = embeddings.detach().cpu()
+            embeddings = embeddings.cpu()
         return embeddings.numpy()
 
     def search(self, tensor, tensor_modality, index_name, n = 5, preprocessing = True):
@@ -135,7 +218,70 @@ class SearchEngine():
         """
         assert index_name in self.indexes, "index_name not recognized"
         index = self.indexes[index_name]
-        model = self.models[index.model_name]
+        embeddings, is_single_vector = self.embed(tensor, tensor_modality, index.model_name, preprocessing = preprocessing)
+        distances, idxs = self.search_embeddings(embeddings, index_name, n)
+
+        if is_single_vector:
+            return distances[0], idxs[0]
+        else:
+            return distances, idxs
+
+    def search_indexes(self, target, modality, index_names = None, n = 5, dataset_name = None, preprocessing = True):
+        """
+        Searches many indexes for the nearest n neighbors of a raw target in one call, see search_target
+
+        The target is converted once, embedded once per distinct model, and the indexes are searched in parallel
+
+        Parameters:
+        target (object): Raw target to search with
+        modality (str): Modality of the target
+        index_names (list of str): Names of indexes to search in, every index valid for modality if None
+        n (int): Number of results to be returned per index
+        dataset_name (str): Name of dataset the target should look like it came from, defaults to the first dataset of modality
+        preprocessing (bool): if target should be preprocessed before embedding extraction
+
+        Returns:
+        dict: Distances and indices of the results, by index name
+        """
+        if index_names is None:
+            index_names = self.valid_index_names(modality)
+        if dataset_name is None:
+            dataset_name = self.modalities[modality]["dataset_names"][0]
+        identity = target_identity(target)
+        keys = {i: (i, identity, dataset_name, n, self.indexes[i].post_processing, preprocessing) for i in index_names}
+        results = {i: self.cache.get(keys[i]) for i in index_names}
+        missing = [i for i in index_names if results[i] is None]
+        if not missing:
+            return results
+
+        tensor = self.target_to_tensor(target, dataset_name = dataset_name)
+        embeddings = {}
+        for model_name in set(self.indexes[i].model_name for i in missing):
+            embeddings[model_name] = self.embed(tensor, modality, model_name, preprocessing = preprocessing)
+        def search(index_name):
+            model_embeddings, is_single_vector = embeddings[self.indexes[index_name].model_name]
+            distances, idxs = self.search_embeddings(model_embeddings, index_name, n)
+            return (distances[0], idxs[0]) if is_single_vector else (distances, idxs)
+        for index_name, result in zip(missing, self.search_pool.map(search, missing)):
+            self.cache.put(keys[index_name], result)
+            results[index_name] = result
+        return results
+
+    def embed(self, tensor, tensor_modality, model_name, preprocessing = True):
+        """
+        Computes the embeddings of a tensor or a batch of tensors with a model
+
+        Parameters:
+        tensor (arraylike): Tensor, or batch of tensors, to embed
+        tensor_modality (str): Modality of tensor
+        model_name (str): Name of the model
+        preprocessing (bool): if tensor should be preprocessed before embedding extraction
+
+        Returns:
+        arraylike: Embeddings, one row per tensor
+        bool: True if tensor was a single tensor rather than a batch
+        """
+        model = self.models[model_name]
         assert tensor_modality in model.modalities, f"Model '{model.name}' does not support modality '{tensor_modality}'"
 
         m = model
@@ -147,7 +293,8 @@ class SearchEngine():
                 batch = tensor[None,:]
                 is_single_vector = True
                 break
-            elif len(t_shape) == (len(m_dim) + 1) and t_shape[-len(m_dim)] == m_dim:
+            elif len(t_shape) == (len(m_dim) + 1) and t_shape[-len(m_dim):] == m_dim:
+                batch = tensor
                 is_single_vector = False
                 break
             elif preprocessing and preprocessor:
@@ -160,16 +307,72 @@ class SearchEngine():
                 print(f"UNCOMPATIBLE SHAPES: {t_shape}, {m_dim}")
                 raise RuntimeError(f"Provided tensor of shape '{t_shape}' not compatible with index model '{model.name}'")
 
-        embeddings = self.get_embedding(model.name, batch, tensor_modality, preprocessing = preprocessing)
-        if index.post_processing == "binarized":
-            embeddings = binarize(embeddings)
+        return self.get_embedding(model.name, batch, tensor_modality, preprocessing = preprocessing), is_single_vector
 
-        distances, idxs = index.search(embeddings, n)
+    def search_embeddings(self, embeddings, index_name, n = 5):
+        """
+        Searches index for the nearest n neighbors of each row of embeddings, binarizing them for binary indexes
 
-        if is_single_vector:
-            return distances[0], idxs[0]
-        else:
-            return distances, idxs
+        Returns:
+        arraylike, arraylike: Distances and indices of the results of each embedding, one row per embedding
+        """
+        index = self.indexes[index_name]
+        if index.binary:
+            embeddings = pack_embeddings(embeddings, index.threshold)
+        return index.search(embeddings, n)
+
+    def search_batch(self, targets, modality, index_name, n = 5, dataset_name = None, preprocessing = True):
+        """
+        Searches index for the nearest n neighbors of many raw targets at once
+
+        All targets are converted into one batch, embedded in a single forward pass and searched with a single index search
+
+        Parameters:
+        targets (list): Raw targets, see target_to_tensor
+        modality (str): Modality of the targets
+        index_name (str): Name of index to search in
+        n (int): Number of results to be returned per target
+        dataset_name (str): Name of dataset the targets should look like they came from, defaults to the first dataset of modality
+        preprocessing (bool): if targets should be preprocessed before embedding extraction
+
+        Returns:
+        arraylike, arraylike: Distances and indices of the results of each target, one row per target
+        """
+        if dataset_name is None:
+            dataset_name = self.modalities[modality]["dataset_names"][0]
+        batch = self.datasets[dataset_name].targets_to_batch(targets)
+        return self.search(batch, modality, index_name, n = n, preprocessing = preprocessing)
+
+    def search_target(self, target, modality, index_name, n = 5, dataset_name = None, preprocessing = True):
+        """
+        Searches index for the nearest n neighbors of a raw target, see target_to_tensor
+
+        Results are cached by (index_name, target, dataset_name, n, post_processing), so repeated queries
+        skip the conversion, the forward pass and the index search until the index changes. Other queries
+        are micro-batched with concurrent queries if engine_params["batch_window"] is set, see MicroBatcher
+
+        Parameters:
+        target (object): Raw target to search with
+        modality (str): Modality of the target
+        index_name (str): Name of index to search in
+        n (int): Number of results to be returned
+        dataset_name (str): Name of dataset the target should look like it came from, defaults to the first dataset of modality
+        preprocessing (bool): if target should be preprocessed before embedding extraction
+
+        Returns:
+        arraylike, arraylike: Distances and indices of the results
+        """
+        assert index_name in self.indexes, "index_name not recognized"
+        if dataset_name is None:
+            dataset_name = self.modalities[modality]["dataset_names"][0]
+        key = (index_name, target_identity(target), dataset_name, n, self.indexes[index_name].post_processing, preprocessing)
+        result = self.cache.get(key)
+        if result is None:
+            tensor = self.target_to_tensor(target, dataset_name = dataset_name)
+            search = self.batcher.search if self.batcher else self.search
+            result = search(tensor, modality, index_name, n = n, preprocessing = preprocessing)
+            self.cache.put(key, result)
+        return result
     
     def add_model(self, model_params, force_add = False):
         """
@@ -207,6 +410,40 @@ class SearchEngine():
                 warnings.warn(f"Preprocessor {preprocessor} is not compatible with modality {modality}")
         model.add_preprocessor(modality, preprocessor)
     
+    def quantization_drift(self, model_name, dataset_name, n = 256, batch_size = 64):
+        """
+        Reports how much the embeddings of a model's quantized embedding nets drift from its float embedding nets
+
+        Parameters:
+        model_name (str): Name of the model, see Model.quantize
+        dataset_name (str): Name of the dataset the sample is drawn from
+        n (int): Number of items sampled
+        batch_size (int): The size of a batch of data being processed
+
+        Returns:
+        dict: Mean and minimum cosine similarity, and mean relative L2 error, of quantized to float embeddings
+        """
+        model = self.models[model_name]
+        dataset = self.datasets[dataset_name]
+        positions = np.sort(np.random.permutation(len(dataset))[:n])
+        similarities, errors = [], []
+        for _, batch in dataset.get_data(batch_size, positions = positions):
+            float_embeddings = model.get_embedding(batch, dataset.modality, quantized = False).cpu().numpy().reshape(len(batch), -1)
+            quantized_embeddings = model.get_embedding(batch, dataset.modality, quantized = True).cpu().numpy().reshape(len(batch), -1)
+            float_norms = np.linalg.norm(float_embeddings, axis = 1)
+            quantized_norms = np.linalg.norm(quantized_embeddings, axis = 1)
+            similarities.append(np.sum(float_embeddings * quantized_embeddings, axis = 1) / np.maximum(float_norms * quantized_norms, 1e-12))
+            errors.append(np.linalg.norm(float_embeddings - quantized_embeddings, axis = 1) / np.maximum(float_norms, 1e-12))
+        similarities, errors = np.concatenate(similarities), np.concatenate(errors)
+        drift = {
+            "num_samples": len(similarities),
+            "mean_cosine_similarity": float(np.mean(similarities)),
+            "min_cosine_similarity": float(np.min(similarities)),
+            "mean_relative_error": float(np.mean(errors))
+        }
+        self.vprint(f"Quantization drift of '{model_name}' on '{dataset_name}': {drift}")
+        return drift
+
     def add_dataset(self, dataset_params, force_add = False):
         """
         Initializes dataset object
@@ -224,7 +461,9 @@ class SearchEngine():
             assert (dataset_params["name"] not in self.datasets), "Dataset with given name already in self.datasets"
         assert (dataset_params["modality"] in self.modalities), f"Modality not supported by {str(self)}"
 
-        if "image" == dataset_params["modality"]:
+        if "image" == dataset_params["modality"] and "tar" == dataset_params.get("source"):
+            dataset = TarImageDataset(self, dataset_params)
+        elif "image" == dataset_params["modality"]:
             dataset = ImageDataset(self, dataset_params)
         elif "text" == dataset_params["modality"]:
             dataset = TextDataset(self, dataset_params)
@@ -236,75 +475,290 @@ class SearchEngine():
         
         self.vprint("Dataset '{}' added".format(dataset.name))
 
-    def build_index(self, index_params, load_embeddings = True, save_embeddings = True, batch_size = 128, message_freq = 1000, force_add = False):
+    def build_index(self, index_params, load_embeddings = True, save_embeddings = True, batch_size = 128, message_freq = 1000, force_add = False,
+            num_workers = 0, prefetch_factor = 2):
         """
         Adds model embeddings of dataset to index
 
         Parameters:
-        index_params (dict): See Index.__init__
+        index_params (dict): See Index.__init__, "index_type" selects the FAISS index to build and
+            "num_shards" splits it across worker processes (see ShardedIndex)
         load_embeddings (bool): True if function should use previously extracted embeddings if they exist
         save_embeddings (bool): True if extracted embeddings should be saved during the function
         batch_size (int): The size of a batch of data being processed
         message_freq (int): How many batches before printing any messages if verbose
         force_add (bool): True if forcefully overwriting any Index with the same name
+        num_workers (int): Number of worker processes decoding the dataset, if not 0 the build is pipelined:
+            workers decode the next batches and a background thread saves embeddings while the model runs
+        prefetch_factor (int): Number of batches each worker decodes ahead, and number of batches waiting to be saved
 
         Returns:
         tuple: Key of index
         """
-        dataset = self.datasets[index_params["dataset_name"]]
-        model = self.models[index_params["model_name"]]
-        assert dataset.modality in model.modalities, "Model does not support dataset modality"
-        assert force_add or index_params["name"] not in self.indexes, "Index with given name already exists"
-        index_params["modality"] = dataset.modality
+        builder = IndexBuilder(self, index_params, load_embeddings = load_embeddings, save_embeddings = save_embeddings, batch_size = batch_size,
+            force_add = force_add, background_save = num_workers > 0, prefetch_factor = prefetch_factor)
+        if builder.start_index < builder.num_batches:
+            try:
+                for batch_idx, batch, preprocessed in self.get_preprocessed_data(builder.model, builder.dataset, batch_size,
+                        start_index = builder.start_index, num_workers = num_workers, prefetch_factor = prefetch_factor):
+                    if not (batch_idx % message_freq):
+                        self.vprint("Processing batch {} of {}".format(batch_idx, builder.num_batches))
+                    builder.add_batch(batch_idx, batch, preprocessed)
+            finally:
+                builder.close()
+        return self.add_index(builder.finish())
+
+    def build_indexes(self, indexes_params = None, load_embeddings = True, save_embeddings = True, batch_size = 128, message_freq = 1000,
+            num_workers = 0, prefetch_factor = 2, build_workers = 4):
+        """
+        Builds many indexes, decoding each dataset once for every index of it, see build_index
 
-        post_processing = ""
-        if "post_processing" in index_params:
-            warnings.warn(f"Index being built is being post processed with {index_params['post_processing']}")
-            post_processing = index_params["post_processing"]
+        Every decoded batch goes through each distinct preprocessor model once, and is then embedded by every
+        model of the dataset's indexes, with the models running in parallel on a pool of build_workers threads
 
-        index = Index(self, index_params)
+        Parameters:
+        indexes_params (list of dict): See Index.__init__, defaults to a flat index named "<model_name>_<dataset_name>"
+            for every pair returned by buildable_indexes(missing = True)
+        load_embeddings (bool): True if previously extracted embeddings should be used if they exist
+        save_embeddings (bool): True if extracted embeddings should be saved during the builds
+        batch_size (int): The size of a batch of data being processed
+        message_freq (int): How many batches before printing any messages if verbose
+        num_workers (int): Number of worker processes decoding each dataset
+        prefetch_factor (int): Number of batches each worker decodes ahead, and number of batches waiting to be saved
+        build_workers (int): Number of threads embedding batches and training indexes
 
-        embedding_dir = f"{self.embedding_dir}/{model.name}/{dataset.name}/{post_processing}/"
-        if not os.path.exists(embedding_dir) and save_embeddings:
-            os.makedirs(embedding_dir)
-        
-        start_time = time.time()
-        self.vprint("Building {}, {} index".format(model.name, dataset.name))
+        Returns:
+        list of str: Names of the indexes built
+        """
+        if indexes_params is None:
+            indexes_params = [{"name": f"{model_name}_{dataset_name}", "model_name": model_name, "dataset_name": dataset_name}
+                for model_name, dataset_name in self.buildable_indexes(missing = True)]
+        by_dataset = {}
+        for index_params in indexes_params:
+            by_dataset.setdefault(index_params["dataset_name"], []).append(index_params)
+
+        index_names = []
+        with ThreadPoolExecutor(build_workers) as pool:
+            for dataset_name, dataset_indexes_params in by_dataset.items():
+                builders = [IndexBuilder(self, index_params, load_embeddings = load_embeddings, save_embeddings = save_embeddings,
+                    batch_size = batch_size, background_save = num_workers > 0, prefetch_factor = prefetch_factor)
+                    for index_params in dataset_indexes_params]
+                embedding_dirs = [builder.embedding_dir for builder in builders]
+                assert len(set(embedding_dirs)) == len(embedding_dirs), "Indexes built together must not share an embedding directory"
+                try:
+                    self.run_builders(builders, pool, batch_size, message_freq, num_workers, prefetch_factor)
+                finally:
+                    for builder in builders:
+                        builder.close()
+                for index in pool.map(IndexBuilder.finish, builders):
+                    index_names.append(self.add_index(index))
+        return index_names
+
+    def run_builders(self, builders, pool, batch_size, message_freq, num_workers, prefetch_factor):
+        """Decodes the dataset of builders once and hands every batch to each of them, see build_indexes"""
+        dataset = builders[0].dataset
+        pending = [builder for builder in builders if builder.start_index < builder.num_batches]
+        if not pending:
+            return
+        start_index = min(builder.start_index for builder in pending)
+        num_batches = pending[0].num_batches
+        # Outputs of preprocessor models, computed or read from their cache once per batch for every model sharing them
+        caches = {}
+        embedding_dirs = [os.path.normpath(builder.embedding_dir) for builder in builders]
+        for builder in pending:
+            preprocessor = builder.model.preprocessors[builder.model.modalities[dataset.modality]]
+            if type(preprocessor) == str and preprocessor not in caches:
+                # The store of a preprocessor whose own index is built along is left to its builder
+                save = os.path.normpath(f"{self.embedding_dir}/{preprocessor}/{dataset.name}") not in embedding_dirs
+                caches[preprocessor] = PreprocessorCache(self, self.models[preprocessor], dataset, batch_size, start_index = start_index, save = save)
+        decode = any(type(builder.model.preprocessors[builder.model.modalities[dataset.modality]]) != str for builder in pending) or \
+            not all(cache.complete() for cache in caches.values())
+        if decode:
+            batches = dataset.get_data(batch_size, start_index = start_index, num_workers = num_workers, prefetch_factor = prefetch_factor)
+        else:
+            batches = ((batch_idx, None) for batch_idx in range(start_index, num_batches))
+        for batch_idx, batch in batches:
+            if not (batch_idx % message_freq):
+                self.vprint("Processing batch {} of {} for {} indexes".format(batch_idx, num_batches, len(pending)))
+            preprocessed = {}
+            for builder in pending:
+                preprocessor = builder.model.preprocessors[builder.model.modalities[dataset.modality]]
+                if type(preprocessor) == str and preprocessor not in preprocessed and batch_idx >= builder.start_index:
+                    preprocessed[preprocessor] = caches[preprocessor].get(batch_idx, batch)
+            for preprocessor, cache in caches.items():
+                # A refilled cache needs every batch, even those no builder needs anymore
+                if cache.fill and preprocessor not in preprocessed:
+                    cache.get(batch_idx, batch)
+            def add_batch(builder):
+                preprocessor = builder.model.preprocessors[builder.model.modalities[dataset.modality]]
+                if type(preprocessor) == str:
+                    builder.add_batch(batch_idx, preprocessed.get(preprocessor), True)
+                else:
+                    builder.add_batch(batch_idx, batch)
+            list(pool.map(add_batch, pending))
+        for cache in caches.values():
+            cache.finish()
+
+    def add_index(self, index):
+        """Adds a built index to the engine, replacing any loaded index with the same name"""
+        if index.name in self.indexes.loaded():
+            self.indexes[index.name].close()
+        self.indexes[index.name] = index
+        self.index_model_names[index.name] = index.model_name
+        self.cache.invalidate(index.name)
+        if index.name not in self.modalities[index.modality]["index_names"]:
+            self.modalities[index.modality]["index_names"].append(index.name)
+        return index.name
 
-        num_batches = int(np.ceil(len(dataset) / batch_size))
-        batch_magnitude = len(str(num_batches))
+    def get_preprocessed_data(self, model, dataset, batch_size, start_index = 0, num_workers = 0, prefetch_factor = 2):
+        """
+        Generator function that returns batches of dataset for model, see Dataset.get_data
 
-        start_index = 0
-        if load_embeddings:
-            for batch_idx, embeddings in self.load_embeddings(embedding_dir, model, post_processing):
-                if not (batch_idx % message_freq):
-                    self.vprint("Loading batch {} of {}".format(batch_idx, num_batches))
-                start_index = batch_idx + 1
-                index.add(embeddings)
+        If the preprocessor of model is another model, batches are returned already preprocessed and the preprocessor's
+        outputs are cached in its embedding store, keyed by item id. A complete cache made by the same preprocessor
+        weights is read instead of running the preprocessor, so models sharing a backbone only run it once per dataset,
+        see PreprocessorCache
 
-        if start_index < num_batches:
-            for batch_idx, batch in dataset.get_data(batch_size, start_index = start_index):
-                if not (batch_idx % message_freq):
-                    self.vprint("Processing batch {} of {}".format(batch_idx, num_batches))
+        Parameters:
+        model (Model): Model the batches are for
+        dataset (Dataset): Dataset to load
+        batch_size (int): The size of a batch of data being processed
+        start_index (int): The index of the first batch to be yielded
+        num_workers (int): Number of worker processes decoding the dataset
+        prefetch_factor (int): Number of batches each worker decodes ahead
 
-                embeddings = model.get_embedding(batch, dataset.modality)
-                if post_processing == "binarized":
-                    embeddings = binarize(embeddings)
+        Yields:
+        int: Batch index
+        arraylike: Batch
+        bool: True if the batch is already preprocessed
+        """
+        preprocessor = model.preprocessors[model.modalities[dataset.modality]]
+        if type(preprocessor) != str:
+            for batch_idx, batch in dataset.get_data(batch_size, start_index = start_index, num_workers = num_workers, prefetch_factor = prefetch_factor):
+                yield batch_idx, batch, False
+            return
+
+        cache = PreprocessorCache(self, self.models[preprocessor], dataset, batch_size, start_index = start_index)
+        if cache.complete():
+            for batch_idx in range(start_index, int(np.ceil(len(dataset) / batch_size))):
+                yield batch_idx, cache.get(batch_idx), True
+            return
+        for batch_idx, batch in dataset.get_data(batch_size, start_index = start_index, num_workers = num_workers, prefetch_factor = prefetch_factor):
+            yield batch_idx, cache.get(batch_idx, batch), True
+        cache.finish()
+
+    def indexes_by_embedding_dir(self, dataset_name):
+        """Returns a dictionary mapping each embedding directory of a dataset to the indexes built from it"""
+        indexes = {}
+        for index in self.indexes.values():
+            if index.dataset_name == dataset_name:
+                indexes.setdefault(index.embedding_dir, []).append(index)
+        return indexes
+
+    def add_items(self, dataset_name, targets, batch_size = 128, save = True):
+        """
+        Adds new items to a dataset and to every index of the dataset, without rebuilding the indexes
 
-                embeddings = embeddings.detach().cpu().numpy()
-                index.add(embeddings)
+        New embeddings are computed once per embedding directory and appended to it as new batches
 
-                if save_embeddings:
-                    filename = "batch_{}".format(str(batch_idx).zfill(batch_magnitude))
-                    save_batch(embeddings, filename, embedding_dir, post_processing = post_processing)
+        Parameters:
+        dataset_name (str): Name of the dataset
+        targets (list): Items to add, see Dataset.add_items
+        batch_size (int): The size of a batch of data being processed
+        save (bool): True if the updated indexes should be saved
 
-        time_elapsed = time.time() - start_time
-        self.vprint("Finished building index {} in {} seconds.".format(index.name, round(time_elapsed, 4)))
-        
-        self.indexes[index.name] = index
-        self.modalities[index.modality]["index_names"].append(index.name)
+        Returns:
+        arraylike: Stable ids of the new items
+        """
+        dataset = self.datasets[dataset_name]
+        positions, ids = dataset.add_items(targets)
+        indexes_by_dir = self.indexes_by_embedding_dir(dataset_name)
+        # Hashed once for every embedding directory
+        fingerprint = dataset.fingerprint() if indexes_by_dir else None
+        for embedding_dir, indexes in indexes_by_dir.items():
+            model = self.models[indexes[0].model_name]
+            if not os.path.exists(embedding_dir):
+                os.makedirs(embedding_dir)
+            store = EmbeddingStore(embedding_dir, model.output_dim, indexes[0].post_processing)
+            manifest = BuildManifest(embedding_dir)
+            for batch_idx, batch in dataset.get_data(batch_size, positions = positions):
+                embeddings = model.get_embedding(batch, dataset.modality).detach().cpu().numpy()
+                if indexes[0].binary:
+                    embeddings = pack_embeddings(embeddings, indexes[0].threshold)
+                batch_ids = ids[batch_idx * batch_size:batch_idx * batch_size + len(embeddings)]
+                start = len(store)
+                store.append(embeddings, batch_ids)
+                if manifest.info is not None:
+                    manifest.commit(store, start, len(store))
+                for index in indexes:
+                    index.add(embeddings, batch_ids)
+            if manifest.info is not None:
+                manifest.update({"dataset": fingerprint})
+            for index in indexes:
+                index.flush()
+                self.cache.invalidate(index.name)
+                if save:
+                    index.save()
+        self.vprint(f"Added {len(ids)} items to '{dataset_name}'")
+        return ids
+
+    def remove_items(self, dataset_name, targets, save = True):
+        """
+        Removes items from a dataset and from every index of the dataset, without rebuilding the indexes
 
-        return index.name
+        Removed ids are recorded in each embedding directory, so they are skipped when embeddings are loaded.
+        Every index of the dataset is checked before anything is changed, so a removal that one of them does not
+        support leaves the dataset and all of its indexes untouched
+
+        Parameters:
+        dataset_name (str): Name of the dataset
+        targets (list): Items to remove, see Dataset.remove_items
+        save (bool): True if the updated indexes should be saved
+
+        Returns:
+        arraylike: Stable ids of the removed items
+        """
+        dataset = self.datasets[dataset_name]
+        if not len(targets):
+            return np.zeros(0, dtype="int64")
+        indexes_by_dir = self.indexes_by_embedding_dir(dataset_name)
+        unsupported = [index.name for indexes in indexes_by_dir.values() for index in indexes if not index.supports_removal()]
+        if unsupported:
+            raise RuntimeError(f"Indexes {unsupported} of dataset '{dataset_name}' do not support removal, rebuild them instead")
+        ids = dataset.remove_items(targets)
+        # Hashed once for every embedding directory
+        fingerprint = dataset.fingerprint() if indexes_by_dir else None
+        for embedding_dir, indexes in indexes_by_dir.items():
+            if os.path.isdir(embedding_dir):
+                save_removed_ids(embedding_dir, ids)
+                manifest = BuildManifest(embedding_dir)
+                if manifest.info is not None:
+                    manifest.update({"dataset": fingerprint})
+            for index in indexes:
+                index.remove(ids)
+                self.cache.invalidate(index.name)
+                if save:
+                    index.save()
+        self.vprint(f"Removed {len(ids)} items from '{dataset_name}'")
+        return ids
+
+    def sync_dataset(self, dataset_name, batch_size = 128, save = True):
+        """
+        Brings a dataset and its indexes up to date with the dataset's source, see Dataset.scan
+
+        Parameters:
+        dataset_name (str): Name of the dataset
+        batch_size (int): The size of a batch of data being processed
+        save (bool): True if the updated indexes should be saved
+
+        Returns:
+        arraylike: Stable ids of the added items
+        arraylike: Stable ids of the removed items
+        """
+        new, missing = self.datasets[dataset_name].scan()
+        removed_ids = self.remove_items(dataset_name, missing, save = save)
+        added_ids = self.add_items(dataset_name, new, batch_size = batch_size, save = save)
+        return added_ids, removed_ids
             
     def idx_to_target(self, indicies, dataset_name):
         """Takes either an int or a list of ints and returns corresponding targets of dataset
@@ -342,23 +796,54 @@ class SearchEngine():
         dataset = self.datasets[dataset_name]
         return dataset.target_to_tensor(target)
             
-    def load_embeddings(self, embedding_dir, model, post_processing):
+    def load_embeddings(self, embedding_dir, model, post_processing, packed = False, with_ids = False, batch_size = 65536, stop = None):
         """
-        Loads previously saved embeddings from save_directory
+        Loads previously saved embeddings from embedding_dir, see EmbeddingStore
+
+        Float and packed embeddings are yielded as memory-mapped views, without being copied into memory
         
         Parameters:
         embedding_dir (string): Directory of embeddings
         model (Model): Model object with the output dimensions embedddings should be reshaped to
         post_processing (str): "binarized" if embeddings are binarized
+        packed (bool): True if binarized embeddings should be yielded bit-packed
+        with_ids (bool): True if stable ids should be yielded too, embeddings of removed items are then skipped
+        batch_size (int): Number of embeddings yielded at a time
+        stop (int): Number of saved embeddings to load, all of them if None
         
         Yields:
         int: Batch index
         arraylike: Embeddings received from passing data through model
+        arraylike: Stable ids of the embeddings, only if with_ids
+        """
+        store = EmbeddingStore(embedding_dir, model.output_dim, post_processing)
+        stop = len(store) if stop is None else min(stop, len(store))
+        removed = load_removed_ids(embedding_dir) if with_ids else None
+        for batch_idx, start in enumerate(range(0, stop, batch_size)):
+            embeddings, ids = store.get(start, min(start + batch_size, stop), packed = packed)
+            if not with_ids:
+                yield batch_idx, embeddings
+                continue
+            if len(removed):
+                keep = ~np.isin(ids, removed)
+                embeddings, ids = embeddings[keep], ids[keep]
+            yield batch_idx, embeddings, ids
+
+    def sample_embeddings(self, embedding_dir, model, post_processing, n, packed = False):
+        """
+        Draws a random sample of previously saved embeddings, used to train indexes
+
+        Parameters:
+        embedding_dir (string): Directory of embeddings
+        model (Model): Model object with the output dimensions embedddings should be reshaped to
+        post_processing (str): "binarized" if embeddings are binarized
+        n (int): Maximum number of embeddings to sample
+        packed (bool): True if binarized embeddings should be sampled bit-packed
+
+        Returns:
+        arraylike: Up to n embeddings
         """
-        filenames = sorted([f for f in os.listdir(embedding_dir) if f[-4:] == ".npy"])
-        for batch_idx in range(len(filenames)):
-            embeddings = load_batch(filenames[batch_idx], embedding_dir, model.output_dim, post_processing=post_processing)
-            yield batch_idx, embeddings
+        return EmbeddingStore(embedding_dir, model.output_dim, post_processing).sample(n, packed = packed)
      
     def save(self, shallow = False, save_data = False):
         info = {
@@ -372,13 +857,17 @@ class SearchEngine():
             "modality_dicts": self.modalities,
             "modalities": list(self.modalities.keys())
         }
+        for k in ["cache_size", "cache_ttl", "lazy", "prefetch", "batch_window", "max_batch_size", "search_threads", "decode_workers"]:
+            if k in self.params:
+                info[k] = self.params[k]
 
         if not shallow:
-            for _, dataset in self.datasets.items():
+            # Assets that were never loaded are unchanged on disk
+            for _, dataset in self.datasets.loaded().items():
                 dataset.save(save_data = save_data)
-            for _, index in self.indexes.items():
+            for _, index in self.indexes.loaded().items():
                 index.save()
-            for _, model in self.models.items():
+            for _, model in self.models.loaded().items():
                 model.save()
 
         with open(f"{self.name}.engine", "w+") as f:
@@ -1,23 +1,124 @@
 import faiss
+import multiprocessing
+import numpy as np
 import os
 import json
 
+from dime.shard import read_faiss_index, shard_worker, write_faiss_index
+from dime.store import BuildManifest, EmbeddingStore
+from dime.utils import load_removed_ids
+
+INDEX_TYPES = ["flat", "ivf_flat", "ivf_pq", "hnsw"]
+METRICS = ["l2", "ip", "cosine"]
+# Inputs of a build manifest that change the saved embeddings, see Index.is_stale
+MANIFEST_KEYS = ["dataset", "model", "threshold"]
+
 def load_index(engine, index_name):
     """Loads a saved index"""
     with open(f"{engine.index_dir}/{index_name}.index", "r") as f:
         index_params = json.loads(f.read())
-    index = Index(engine, index_params)
+    index = make_index(engine, index_params)
+    if index.read():
+        return index
+    engine.vprint("(native index file missing or stale, rebuilding from embeddings) ", end = "")
     model = engine.models[index.model_name]
-    embedding_dir = f"{engine.embedding_dir}/{index.model_name}/{index.dataset_name}/{index.post_processing}/"
-    for _, embeddings in engine.load_embeddings(embedding_dir, model, index.post_processing):
-        index.add(embeddings)
+    embedding_dir = index.embedding_dir
+    if not index.is_trained():
+        sample = engine.sample_embeddings(embedding_dir, model, index.post_processing, index.train_size, packed = index.binary)
+        if len(sample):
+            index.train(sample)
+    for _, embeddings, ids in engine.load_embeddings(embedding_dir, model, index.post_processing, packed = index.binary, with_ids = True):
+        index.add(embeddings, ids)
+    index.flush()
     return index
 
+def make_index(engine, index_params):
+    """Returns a ShardedIndex if index_params asks for more than one shard, otherwise an Index"""
+    if index_params.get("num_shards", 1) > 1:
+        return ShardedIndex(engine, index_params)
+    return Index(engine, index_params)
+
+def faiss_metric(metric):
+    """Returns the FAISS metric type for "l2", "ip" or "cosine" (inner product of normalized vectors)"""
+    if "l2" == metric:
+        return faiss.METRIC_L2
+    elif metric in ("ip", "cosine"):
+        return faiss.METRIC_INNER_PRODUCT
+    raise RuntimeError(f"Metric '{metric}' not supported, expected one of {METRICS}")
+
+def make_faiss_index(dim, index_params):
+    """
+    Creates an empty FAISS index of the type specified by index_params["index_type"]
+
+    Parameters:
+    dim (int): Dimension of the vectors being indexed
+    index_params (dict): See Index.__init__
+
+    Returns:
+    faiss.Index: Empty (and possibly untrained) FAISS index
+    """
+    index_type = index_params.get("index_type", "flat")
+    if "binarized" == index_params.get("post_processing"):
+        return make_faiss_binary_index(dim, index_params)
+    metric = faiss_metric(index_params.get("metric", "l2"))
+    if "flat" == index_type:
+        return faiss.IndexFlat(dim, metric)
+    elif "ivf_flat" == index_type:
+        quantizer = faiss.IndexFlat(dim, metric)
+        index = faiss.IndexIVFFlat(quantizer, dim, index_params["nlist"], metric)
+    elif "ivf_pq" == index_type:
+        assert dim % index_params["pq_m"] == 0, f"pq_m ({index_params['pq_m']}) must divide dimension {dim}"
+        quantizer = faiss.IndexFlat(dim, metric)
+        index = faiss.IndexIVFPQ(quantizer, dim, index_params["nlist"], index_params["pq_m"], index_params["pq_nbits"], metric)
+    elif "hnsw" == index_type:
+        index = faiss.IndexHNSWFlat(dim, index_params["hnsw_m"], metric)
+        index.hnsw.efConstruction = index_params["ef_construction"]
+        index.hnsw.efSearch = index_params["ef_search"]
+        return index
+    else:
+        raise RuntimeError(f"Index type '{index_type}' not supported, expected one of {INDEX_TYPES}")
+    index.nprobe = index_params["nprobe"]
+    return index
+
+def make_id_map(index, binary = False):
+    """Wraps a FAISS index so that embeddings are added, returned and removed by stable ids"""
+    if binary:
+        return faiss.IndexBinaryIDMap2(index)
+    return faiss.IndexIDMap2(index)
+
+def make_faiss_binary_index(dim, index_params):
+    """
+    Creates an empty FAISS index that compares bit-packed embeddings by Hamming distance
+
+    Parameters:
+    dim (int): Number of bits of the vectors being indexed, must be a multiple of 8
+    index_params (dict): See Index.__init__
+
+    Returns:
+    faiss.IndexBinary: Empty (and possibly untrained) binary FAISS index
+    """
+    assert dim % 8 == 0, f"Binarized indexes need a dimension divisible by 8, received {dim}"
+    index_type = index_params.get("index_type", "flat")
+    if "flat" == index_type:
+        return faiss.IndexBinaryFlat(dim)
+    elif "ivf_flat" == index_type:
+        quantizer = faiss.IndexBinaryFlat(dim)
+        index = faiss.IndexBinaryIVF(quantizer, dim, index_params["nlist"])
+        index.nprobe = index_params["nprobe"]
+        return index
+    elif "hnsw" == index_type:
+        index = faiss.IndexBinaryHNSW(dim, index_params["hnsw_m"])
+        index.hnsw.efConstruction = index_params["ef_construction"]
+        index.hnsw.efSearch = index_params["ef_search"]
+        return index
+    else:
+        raise RuntimeError(f"Index type '{index_type}' not supported for binarized indexes")
+
 class Index():
     def __init__(self, engine, index_params):
         """
         Index class
-        
+
         Parameters:
         engine (SearchEngine): SearchEngine instance that model is part of
         index_params (dict): {
@@ -25,14 +126,25 @@ class Index():
             "model_name":       (str) name of the model of index
             "dataset_name":     (str) name of the dataset of index
             "modality":         (str) modality of dataset being indexed
-            "post_processing":  (str) "binarized" or ""
+            "post_processing":  (str) "binarized" or "", binarized indexes hold bit-packed embeddings
             "threshold":        (float) threshold for binarization
-            "desc":             (str) A description 
+            "index_type":       (str) "flat" (default), "ivf_flat", "ivf_pq" or "hnsw"
+            "metric":           (str) "l2" (default), "ip" or "cosine", always "hamming" if binarized
+            "nlist":            (int) number of IVF cells (ivf_flat, ivf_pq)
+            "nprobe":           (int) number of IVF cells visited per query (ivf_flat, ivf_pq)
+            "pq_m":             (int) number of PQ subquantizers, must divide dim (ivf_pq)
+            "pq_nbits":         (int) bits per PQ subquantizer code (ivf_pq)
+            "hnsw_m":           (int) number of neighbors per HNSW node (hnsw)
+            "ef_construction":  (int) HNSW search depth while adding (hnsw)
+            "ef_search":        (int) HNSW search depth while searching (hnsw)
+            "train_size":       (int) number of embeddings sampled to train the index
+            "mmap":             (bool) True (default) if the saved FAISS index file should be memory-mapped
+            "desc":             (str) A description
         }
         """
         self.engine = engine
         self.params = index_params
-        
+
         self.name = index_params["name"]
         self.model_name = index_params["model_name"]
         self.dataset_name = index_params["dataset_name"]
@@ -45,29 +157,400 @@ class Index():
                 self.threshold = index_params["threshold"]
         else:
             self.post_processing = ""
+        self.binary = "binarized" == self.post_processing
+
+        index_params.setdefault("metric", "hamming" if self.binary else "l2")
+        self.metric = index_params["metric"]
+        assert (self.metric == "hamming") == self.binary, f"Metric '{self.metric}' not supported with post_processing '{self.post_processing}'"
+
+        index_params.setdefault("index_type", "flat")
+        index_params.setdefault("nlist", 1024)
+        index_params.setdefault("nprobe", 16)
+        index_params.setdefault("pq_m", 16)
+        index_params.setdefault("pq_nbits", 8)
+        index_params.setdefault("hnsw_m", 32)
+        index_params.setdefault("ef_construction", 40)
+        index_params.setdefault("ef_search", 64)
+        index_params.setdefault("train_size", 64 * index_params["nlist"])
+        self.index_type = index_params["index_type"]
+        self.train_size = index_params["train_size"]
 
         self.dim = tuple(self.engine.models[self.model_name].output_dim)
         assert len(self.dim) == 1, "FAISS search only supports 1 dimensional vectors"
-        self.index = faiss.IndexFlatL2(self.dim[0])
+        self.index = make_id_map(make_faiss_index(self.dim[0], index_params), self.binary)
         self.input_modalities = list(self.engine.models[self.model_name].modalities.keys())
-    
-    def add(self, embeddings):
-        """Add embeddings to index"""
-        self.index.add(embeddings)
+        self.embedding_dir = f"{self.engine.embedding_dir}/{self.model_name}/{self.dataset_name}/{self.post_processing}/"
+        self.index_file = f"{self.engine.index_dir}/{self.name}.faiss"
+        self.mmap = index_params.get("mmap", True)
+
+        # True while self.index matches the contents of index_file
+        self.synced = False
+        # True while self.index is memory-mapped from index_file, and therefore read-only
+        self.mapped = False
+
+        # Stable id given to embeddings added without ids, one past the largest id added so far
+        self.next_id = index_params.get("next_id", 0)
+
+        # Embeddings waiting for the index to be trained, see Index.add
+        self.pending = []
+        self.pending_ids = []
+        self.num_pending = 0
+
+    def is_trained(self):
+        """Returns True if the index can be added to without training"""
+        return self.index.is_trained
+
+    def normalize(self, embeddings):
+        """Returns embeddings scaled to unit length if the metric is cosine, otherwise returns them unchanged"""
+        if self.metric != "cosine":
+            return embeddings
+        embeddings = np.array(embeddings, dtype="float32", order="C")
+        faiss.normalize_L2(embeddings)
+        return embeddings
+
+    def train(self, embeddings, normalize = True):
+        """
+        Trains the index on a sample of the embeddings that will be added to it
+
+        Does nothing if the index does not require training
+
+        Parameters:
+        embeddings (arraylike): Sample of embeddings to train on
+        normalize (bool): False if embeddings have already gone through Index.normalize
+        """
+        if self.is_trained():
+            return
+        if normalize:
+            embeddings = self.normalize(embeddings)
+        nlist = self.params["nlist"]
+        assert len(embeddings) >= nlist, \
+            f"Index '{self.name}' needs at least {nlist} embeddings to train, received {len(embeddings)}"
+        self.index.train(np.ascontiguousarray(embeddings, dtype="uint8" if self.binary else "float32"))
+
+    def add(self, embeddings, ids = None):
+        """
+        Add embeddings to index, binarized indexes expect bit-packed uint8 embeddings
+
+        If the index still needs training, embeddings are held back until train_size of them
+        have been received, at which point the index is trained on them and they are added
+
+        Parameters:
+        embeddings (arraylike): Embeddings to add
+        ids (arraylike): Stable ids of the embeddings, see Dataset.ids, defaults to consecutive ids after self.next_id
+        """
+        if ids is None:
+            ids = np.arange(self.next_id, self.next_id + len(embeddings), dtype="int64")
+        ids = np.asarray(ids, dtype="int64")
+        if len(ids):
+            self.next_id = max(self.next_id, int(ids.max()) + 1)
+        self.synced = False
+        embeddings = self.normalize(embeddings)
+        if self.is_trained():
+            self.ensure_writable()
+            self.add_trained(embeddings, ids)
+            return
+        self.pending.append(embeddings)
+        self.pending_ids.append(ids)
+        self.num_pending += len(embeddings)
+        if self.num_pending >= self.train_size:
+            self.flush()
+
+    def flush(self):
+        """Trains the index on any held back embeddings and adds them"""
+        if not self.pending:
+            return
+        pending = np.concatenate(self.pending)
+        pending_ids = np.concatenate(self.pending_ids)
+        self.pending = []
+        self.pending_ids = []
+        self.num_pending = 0
+        if not self.is_trained():
+            sample = pending[np.random.permutation(len(pending))[:self.train_size]]
+            self.train(sample, normalize = False)
+        self.add_trained(pending, pending_ids)
+
+    def add_trained(self, embeddings, ids):
+        """Adds normalized embeddings to the trained FAISS index under their ids"""
+        self.index.add_with_ids(embeddings, ids)
+
+    def supports_removal(self):
+        """Returns True if embeddings can be removed from the index, HNSW indexes have to be rebuilt instead"""
+        return "hnsw" != self.index_type
+
+    def remove(self, ids):
+        """
+        Removes embeddings from the index by their stable ids
+
+        Parameters:
+        ids (arraylike): Stable ids of the embeddings to remove
+
+        Returns:
+        int: Number of embeddings removed
+        """
+        if not self.supports_removal():
+            raise RuntimeError(f"Index '{self.name}' is an HNSW index, which does not support removal, rebuild it instead")
+        self.flush()
+        self.ensure_writable()
+        self.synced = False
+        return self.remove_trained(np.asarray(ids, dtype="int64"))
+
+    def remove_trained(self, ids):
+        """Removes ids from the FAISS index"""
+        return self.index.remove_ids(ids)
+
+    def ensure_writable(self):
+        """Replaces a memory-mapped index with an in-memory copy so that it can be modified"""
+        if self.mapped:
+            self.index = read_faiss_index(self.index_file, self.binary)
+            self.mapped = False
 
     def search(self, embeddings, n):
-        """Returns (distances, indices) of n closest neighbors to each embedding"""
-        return self.index.search(embeddings, n)
+        """
+        Returns (distances, indices) of n closest neighbors to each embedding
+
+        Distances are Hamming distances if binarized, and similarities (higher is closer) for "ip" and "cosine"
+        """
+        self.flush()
+        return self.index.search(self.normalize(embeddings), n)
+
+    def is_stale(self):
+        """
+        Returns True if index_file is missing, or was built from different saved embeddings
+        or holds a different number of embeddings than them
+
+        The saved embeddings are compared by the inputs recorded in their build manifest, or by
+        modification time if they were saved without one (or the index was saved before manifests)
+
+        An index_file built without saving embeddings is never considered stale
+        """
+        index_files = self.index_files()
+        if not all(os.path.isfile(f) for f in index_files) or "ntotal" not in self.params:
+            return True
+        store = EmbeddingStore(self.embedding_dir, self.dim, self.post_processing)
+        if not len(store):
+            return False
+        manifest = BuildManifest(self.embedding_dir)
+        if manifest.info is not None and "embedding_inputs" in self.params:
+            if manifest.changed_inputs(self.params["embedding_inputs"], MANIFEST_KEYS):
+                return True
+        elif store.mtime() > min(os.path.getmtime(f) for f in index_files):
+            return True
+        return len(store) - len(load_removed_ids(self.embedding_dir)) != self.params["ntotal"]
+
+    def index_files(self):
+        """Returns the paths of the native FAISS index files written by Index.save"""
+        return [self.index_file]
+
+    def io_flags(self):
+        """Returns the FAISS IO flags used to memory-map saved index files if self.mmap"""
+        if not self.mmap:
+            return 0
+        if self.index_type in ("ivf_flat", "ivf_pq"):
+            return faiss.IO_FLAG_MMAP
+        # Memory-mapping flat codes is only available in newer versions of FAISS
+        return getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+    def read(self):
+        """
+        Reads the native FAISS index saved by Index.save, memory-mapped if self.mmap
+
+        Returns:
+        bool: True if the index was read, False if index_file is missing or stale
+        """
+        if self.is_stale():
+            return False
+        io_flags = self.io_flags()
+        index = read_faiss_index(self.index_file, self.binary, io_flags)
+        if not hasattr(index, "id_map") or index.d != self.dim[0] or index.ntotal != self.params["ntotal"]:
+            return False
+        if not self.binary and index.metric_type != faiss_metric(self.metric):
+            return False
+        self.index = index
+        self.synced = True
+        self.mapped = io_flags != 0
+        return True
+
+    def write(self):
+        """Writes the native FAISS index to index_file"""
+        write_faiss_index(self.index, self.index_file, self.binary)
 
     def save(self):
         """Saves index and index information to index_dir"""
+        self.flush()
+        if not self.synced:
+            self.write()
+            self.synced = True
+
         info = self.params
         info["dim"] = self.dim
+        info["ntotal"] = len(self)
+        info["next_id"] = self.next_id
+        manifest = BuildManifest(self.embedding_dir)
+        if manifest.info is not None:
+            info["embedding_inputs"] = {k: manifest.info["inputs"].get(k) for k in MANIFEST_KEYS}
         info = json.dumps(info)
         with open(f"{self.engine.index_dir}/{self.name}.index", "w+") as f:
             f.write(info)
 
+    def close(self):
+        """Releases any resources held by the index, see ShardedIndex.close"""
+        pass
+
+    def __len__(self):
+        """Returns length of index"""
+        return self.index.ntotal + self.num_pending
+
+class ShardedIndex(Index):
+    def __init__(self, engine, index_params):
+        """
+        Index split across worker processes, so that it is not limited to what one process can hold
+
+        Batches of embeddings are distributed round-robin across the shards under their stable ids,
+        searches query every shard in parallel and merge the per-shard results into one ranking
+
+        Parameters:
+        engine (SearchEngine): SearchEngine instance that model is part of
+        index_params (dict): See Index.__init__, with the addition of {
+            "num_shards":       (int) number of worker processes holding the index
+        }
+        """
+        super().__init__(engine, index_params)
+        self.num_shards = index_params["num_shards"]
+
+        # self.index is only used as a template that is trained and then copied to every shard
+        self.shards_ready = False
+        self.ntotal = 0
+        self.next_shard = 0
+
+        # Workers are spawned rather than forked, FAISS' OpenMP threads do not survive a fork
+        context = multiprocessing.get_context("spawn")
+        self.connections = []
+        self.workers = []
+        for _ in range(self.num_shards):
+            conn, worker_conn = context.Pipe()
+            worker = context.Process(target = shard_worker, args = (worker_conn, self.binary), daemon = True)
+            worker.start()
+            self.connections.append(conn)
+            self.workers.append(worker)
+
+    def receive(self, shard_ids):
+        """Waits for a reply from each shard in shard_ids and returns their results"""
+        results = []
+        for i in shard_ids:
+            error, result = self.connections[i].recv()
+            if error is not None:
+                raise RuntimeError(f"Shard {i} of index '{self.name}' failed: {error!r}")
+            results.append(result)
+        return results
+
+    def request(self, shard_ids, command, args = None):
+        """Sends a command to each shard in shard_ids, see shard_worker, and returns their results"""
+        for i in shard_ids:
+            self.connections[i].send((command, args))
+        return self.receive(shard_ids)
+
+    def is_trained(self):
+        """Returns True if the index can be added to without training, shards read by read are already trained"""
+        return self.shards_ready or self.index.is_trained
+
+    def init_shards(self):
+        """Copies the trained, empty template index to every shard"""
+        if self.binary:
+            template = faiss.serialize_index_binary(self.index)
+        else:
+            template = faiss.serialize_index(self.index)
+        self.request(range(self.num_shards), "init", template)
+        self.shards_ready = True
+
+    def add_trained(self, embeddings, ids):
+        """Adds normalized embeddings to the next shard under their ids"""
+        if not self.shards_ready:
+            self.init_shards()
+        self.request([self.next_shard], "add", (embeddings, ids))
+        self.ntotal += len(embeddings)
+        self.next_shard = (self.next_shard + 1) % self.num_shards
+
+    def remove_trained(self, ids):
+        """Removes ids from every shard"""
+        if not self.shards_ready:
+            return 0
+        num_removed = sum(self.request(range(self.num_shards), "remove", ids))
+        self.ntotal -= num_removed
+        return num_removed
+
+    def ensure_writable(self):
+        """Has every shard replace its memory-mapped index with an in-memory copy"""
+        if self.mapped:
+            for i, index_file in enumerate(self.index_files()):
+                self.connections[i].send(("read", (index_file, 0)))
+            self.receive(range(self.num_shards))
+            self.mapped = False
+
+    def search(self, embeddings, n):
+        """
+        Returns (distances, indices) of n closest neighbors to each embedding across all shards
+
+        See Index.search
+        """
+        self.flush()
+        if not self.shards_ready:
+            self.init_shards()
+        results = self.request(range(self.num_shards), "search", (self.normalize(embeddings), n))
+        distances = np.concatenate([d for d, _ in results], axis = 1)
+        idxs = np.concatenate([i for _, i in results], axis = 1)
+        if self.metric in ("ip", "cosine"):
+            order = np.argsort(-distances, axis = 1, kind = "stable")[:, :n]
+        else:
+            order = np.argsort(distances, axis = 1, kind = "stable")[:, :n]
+        return np.take_along_axis(distances, order, axis = 1), np.take_along_axis(idxs, order, axis = 1)
+
+    def index_files(self):
+        """Returns the paths of the native FAISS index files of every shard"""
+        return [f"{self.engine.index_dir}/{self.name}.shard{i}.faiss" for i in range(self.num_shards)]
+
+    def read(self):
+        """
+        Has every shard read its own native FAISS index file, see Index.read
+
+        Returns:
+        bool: True if the shards were read, False if any shard file is missing or stale
+        """
+        if self.is_stale():
+            return False
+        io_flags = self.io_flags()
+        for i, index_file in enumerate(self.index_files()):
+            self.connections[i].send(("read", (index_file, io_flags)))
+        shard_info = self.receive(range(self.num_shards))
+
+        if any(d != self.dim[0] or not has_id_map for d, _, _, has_id_map in shard_info):
+            return False
+        if not self.binary and any(metric_type != faiss_metric(self.metric) for _, _, metric_type, _ in shard_info):
+            return False
+        ntotal = sum(ntotal for _, ntotal, _, _ in shard_info)
+        if ntotal != self.params["ntotal"]:
+            return False
+        self.ntotal = ntotal
+        self.next_shard = self.params.get("next_shard", 0)
+        self.shards_ready = True
+        self.synced = True
+        self.mapped = io_flags != 0
+        return True
+
+    def write(self):
+        """Has every shard write its own native FAISS index file"""
+        if not self.shards_ready:
+            self.init_shards()
+        for i, index_file in enumerate(self.index_files()):
+            self.connections[i].send(("write", index_file))
+        self.receive(range(self.num_shards))
+        self.params["next_shard"] = self.next_shard
+
+    def close(self):
+        """Stops the shard worker processes"""
+        self.request(range(self.num_shards), "close")
+        for worker in self.workers:
+            worker.join()
+
     def __len__(self):
         """Returns length of index"""
-        return self.index.ntotal
-        
\ No newline at end of file
+        return self.ntotal + self.num_pending
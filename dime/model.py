@@ -1,19 +1,91 @@
+import hashlib
 import numpy as np
 import warnings
 import os
 import pickle
+import copy
 import json
+import torch
+
+from dime.backends import OnnxNet, export_onnx
 
 def load_model(engine, model_name):
     """Loads a saved model"""
     model_dir = f"{engine.model_dir}/{model_name}"
     with open(f"{model_dir}/model.txt", "r") as f:
         model_params = json.loads(f.read())
+    if "onnx" == model_params.get("backend", "torch"):
+        # Exported graphs replace the pickled modules, the whole preprocessor chain is used in place of a frozen graph
+        num_threads = model_params.get("onnx_threads", 0)
+        model_params["embedding_nets"] = [OnnxNet(f"{model_dir}/{m}.head.onnx", num_threads) for m in model_params["modalities"]]
+        model_params["frozen_nets"] = [OnnxNet(f"{model_dir}/{m}.onnx", num_threads) for m in model_params["modalities"]]
+        return Model(engine, model_params)
     model_params["embedding_nets"] = []
     for modality in model_params["modalities"]:
         with open(f"{model_dir}/embedding_nets/{modality}.nn.pkl", "rb") as f:
             model_params["embedding_nets"].append(pickle.load(f))
-    return Model(engine, model_params)
+    model_params["frozen_nets"] = [None for _ in model_params["modalities"]]
+    # Checked against the embedding chain on first use, see Model.frozen_net
+    model_params["frozen_fingerprints"] = [model_params.get("frozen_fingerprints", {}).get(m) for m in model_params["modalities"]]
+    for modality in model_params.get("frozen", []):
+        frozen_net = torch.jit.load(f"{model_dir}/{modality}.frozen.pt", map_location = "cuda" if engine.cuda else "cpu")
+        model_params["frozen_nets"][model_params["modalities"].index(modality)] = frozen_net
+    if model_params.get("quantized", False):
+        # Cached int8 nets are only reused if they were quantized from the current weights
+        model_params["quantized_nets"] = []
+        for modality, embedding_net in zip(model_params["modalities"], model_params["embedding_nets"]):
+            path = f"{model_dir}/embedding_nets/{modality}.int8.pt"
+            cache = torch.load(path, weights_only = False) if os.path.isfile(path) else None
+            if cache is not None and cache["fingerprint"] == net_fingerprint(embedding_net):
+                model_params["quantized_nets"].append(cache["net"])
+            else:
+                model_params["quantized_nets"].append(None)
+    model = Model(engine, model_params)
+    if model.quantized and None in model_params["quantized_nets"]:
+        model.save_quantized()
+    return model
+
+def net_fingerprint(embedding_net):
+    """Returns a hash of the weights of an embedding net"""
+    h = hashlib.sha1()
+    if isinstance(embedding_net, OnnxNet):
+        h.update(embedding_net.fingerprint().encode())
+    elif hasattr(embedding_net, "state_dict"):
+        for name, tensor in embedding_net.state_dict().items():
+            h.update(name.encode())
+            h.update(tensor.detach().cpu().numpy().tobytes())
+    else:
+        h.update(pickle.dumps(embedding_net))
+    return h.hexdigest()
+
+def quantize_net(embedding_net):
+    """Returns an int8 dynamically quantized copy of the linear layers of an embedding net, or None if it is not a module"""
+    if not isinstance(embedding_net, torch.nn.Module):
+        return None
+    embedding_net = copy.deepcopy(embedding_net).cpu().eval()
+    return torch.ao.quantization.quantize_dynamic(embedding_net, {torch.nn.Linear}, dtype = torch.qint8)
+
+class EmbeddingChain(torch.nn.Module):
+    def __init__(self, steps, output_dims):
+        """
+        Runs a chain of preprocessors and embedding nets as one module, so it can be traced into one graph
+
+        Parameters:
+            steps (list of callables): Preprocessors and embedding nets, in the order they are applied
+            output_dims (list of tuples): Shape each step's output is viewed as, None to keep it as is
+        """
+        super().__init__()
+        self.steps = steps
+        # Registers the steps that are modules, so their weights are part of the traced graph
+        self.nets = torch.nn.ModuleList([step for step in steps if isinstance(step, torch.nn.Module)])
+        self.output_dims = output_dims
+
+    def forward(self, batch):
+        for step, output_dim in zip(self.steps, self.output_dims):
+            batch = step(batch)
+            if output_dim is not None:
+                batch = batch.view((batch.shape[0],) + output_dim)
+        return batch
 
 class Model():
     def __init__(self, engine, model_params):
@@ -29,6 +101,13 @@ class Model():
             "embedding_nets":   (list) A list of callables corresponding to each modality
             "input_dim":        (list) A list of tuples corresponding to each modality
             "preprocessors:     (list) A list of either strings or callables corresponding to each modality
+            "inference_mode":   (bool) True (default) if embeddings are computed under torch.inference_mode, otherwise under torch.no_grad
+            "frozen_nets":      (list) Frozen TorchScript graphs corresponding to each modality or None, see Model.freeze
+            "frozen_fingerprints": (list) chain_fingerprint each frozen graph was traced from or None, graphs that no longer match are dropped
+            "quantized":        (bool) True if embeddings are computed by int8 dynamically quantized copies of the embedding nets, CPU only
+            "quantized_nets":   (list) Quantized copies of the embedding nets or None, missing ones are quantized on creation
+            "backend":          (str) "torch" (default), or "onnx" if load_model should run the graphs written by Model.export_onnx
+            "onnx_threads":     (int) Number of threads of each ONNX Runtime forward pass, 0 (default) lets ONNX Runtime decide
             "desc":             (str) A description
         }
         """
@@ -59,6 +138,21 @@ class Model():
             except:
                 continue
 
+        self.backend = model_params.get("backend", "torch")
+        self.onnx_threads = model_params.get("onnx_threads", 0)
+        self.inference_mode = model_params.get("inference_mode", True)
+        self.frozen_nets = model_params.get("frozen_nets", [None for _ in range(len(self.modalities))])
+        self.frozen_fingerprints = model_params.get("frozen_fingerprints", [None for _ in range(len(self.modalities))])
+        self.unverified = {i for i, fingerprint in enumerate(self.frozen_fingerprints) if fingerprint is not None}
+
+        self.quantized = model_params.get("quantized", False)
+        self.quantized_nets = model_params.get("quantized_nets", [None for _ in range(len(self.modalities))])
+        if self.quantized and self.cuda:
+            warnings.warn(f"Quantized embedding nets only run on CPU, model '{self.name}' uses its float embedding nets")
+            self.quantized = False
+        if self.quantized:
+            self.quantize()
+
         if [modality for modality in self.modalities.keys() if modality not in self.engine.modalities]:
             warnings.warn("Model created with unsupported modalities")
 
@@ -87,19 +181,146 @@ class Model():
         """
         i = self.modalities[modality]
         self.preprocessors[i] = preprocessor
+        # The frozen graph holds the previous preprocessor
+        self.frozen_nets[i] = None
+
+    def quantize(self):
+        """Computes embeddings with int8 dynamically quantized copies of the embedding nets from now on"""
+        assert not self.cuda, "Quantized embedding nets only run on CPU"
+        self.quantized = True
+        for i, embedding_net in enumerate(self.embedding_nets):
+            if self.quantized_nets[i] is None:
+                self.quantized_nets[i] = quantize_net(embedding_net)
+                # The frozen graph holds the float embedding net
+                self.frozen_nets[i] = None
+
+    def embedding_net(self, modality, quantized = None):
+        """Returns the embedding net of modality, its quantized copy if quantized (defaults to self.quantized)"""
+        i = self.modalities[modality]
+        quantized = self.quantized if quantized is None else quantized
+        if quantized and self.quantized_nets[i] is not None:
+            return self.quantized_nets[i]
+        return self.embedding_nets[i]
+
+    def embedding_chain(self, modality):
+        """Returns the preprocessors and embedding nets get_embedding applies, and the shapes of their outputs"""
+        i = self.modalities[modality]
+        preprocessor = self.preprocessors[i]
+        if type(preprocessor) == str:
+            steps, output_dims = self.engine.models[preprocessor].embedding_chain(modality)
+        elif preprocessor is not None:
+            steps, output_dims = [preprocessor], [None]
+        else:
+            steps, output_dims = [], []
+        return steps + [self.embedding_net(modality)], output_dims + [self.output_dim]
+
+    def freeze(self, modality, example = None):
+        """
+        Traces the embedding net of modality, along with its preprocessors, into one frozen TorchScript graph
+
+        The graph is used by get_embedding when preprocessing, and saved next to model.txt by save
+
+        Parameters:
+        modality (str): Modality of the embedding net
+        example (arraylike): Example batch to trace with, random values of the chain's input dimension if None
+        """
+        i = self.modalities[modality]
+        steps, output_dims = self.embedding_chain(modality)
+        if example is None:
+            example = self.example_batch(modality)
+        chain = EmbeddingChain(steps, output_dims).eval()
+        with torch.no_grad():
+            self.frozen_nets[i] = torch.jit.freeze(torch.jit.trace(chain, example, check_trace = False))
+        self.frozen_fingerprints[i] = self.chain_fingerprint(modality)
+        self.unverified.discard(i)
+
+    def frozen_net(self, modality):
+        """
+        Returns the frozen graph of modality, or None if it has none
+
+        A graph saved with the fingerprint of its embedding chain is checked on first use, and dropped if any
+        of the nets it was traced from changed since, so get_embedding runs the current nets instead
+        """
+        i = self.modalities[modality]
+        if i in self.unverified:
+            self.unverified.discard(i)
+            if self.frozen_nets[i] is not None and self.frozen_fingerprints[i] != self.chain_fingerprint(modality):
+                warnings.warn(f"Frozen graph of model '{self.name}' for {modality} is out of date, freeze it again")
+                self.frozen_nets[i] = None
+        return self.frozen_nets[i]
+
+    def example_batch(self, modality):
+        """Returns a batch of random values of the input dimension of the first model of the preprocessor chain of modality"""
+        m = self
+        while type(m.preprocessors[m.modalities[modality]]) == str:
+            m = self.engine.models[m.preprocessors[m.modalities[modality]]]
+        example = torch.rand((2,) + m.input_dim[m.modalities[modality]])
+        return example.cuda() if self.cuda else example
+
+    def export_onnx(self, modality, example = None):
+        """
+        Exports the embedding net of modality to ONNX, for models whose model.txt selects the "onnx" backend
+
+        Writes <modality>.onnx, the embedding net along with its preprocessors, and <modality>.head.onnx,
+        the embedding net alone, next to model.txt
+
+        Parameters:
+        modality (str): Modality of the embedding net
+        example (arraylike): Example batch to export with, random values of the chain's input dimension if None
+        """
+        i = self.modalities[modality]
+        model_dir = os.path.normpath(f"{self.engine.model_dir}/{self.name}/")
+        if not os.path.isdir(model_dir):
+            os.makedirs(model_dir)
+        steps, output_dims = self.embedding_chain(modality)
+        if example is None:
+            example = self.example_batch(modality)
+        export_onnx(EmbeddingChain(steps, output_dims), example, f"{model_dir}/{modality}.onnx")
+        head_example = torch.rand((2,) + self.input_dim[i])
+        export_onnx(EmbeddingChain(steps[-1:], output_dims[-1:]), head_example.cuda() if self.cuda else head_example,
+            f"{model_dir}/{modality}.head.onnx")
+
+    def get_embedding(self, batch, modality, preprocessing = True, quantized = None):
+        """
+        Get embedding of a batch, without tracking gradients
+
+        quantized selects the quantized or float embedding nets of the model and its preprocessors, defaults to self.quantized
+        """
+        with torch.inference_mode() if self.inference_mode else torch.no_grad():
+            return self.compute_embedding(batch, modality, preprocessing, quantized)
 
-    def get_embedding(self, batch, modality, preprocessing = True):
-        """Get embedding of a batch"""
+    def compute_embedding(self, batch, modality, preprocessing = True, quantized = None):
         i = self.modalities[modality]
         num_batch = (len(batch),)
+        if preprocessing and quantized is None and self.frozen_net(modality) is not None:
+            return self.frozen_nets[i](batch).view(num_batch + self.output_dim)
         if preprocessing and self.preprocessors[i] is not None:
             preprocessor = self.preprocessors[i]
             if type(preprocessor) == str:
-                #TODO: change this so that preprocessed items are loaded instead of being calculated
-                batch = self.engine.models[preprocessor].get_embedding(batch, modality, preprocessing = preprocessing)
+                # Dataset items are read preprocessed from a cache instead, see SearchEngine.get_preprocessed_data
+                batch = self.engine.models[preprocessor].get_embedding(batch, modality, preprocessing = preprocessing, quantized = quantized)
             else:
                 batch = preprocessor(batch)
-        return self.embedding_nets[i](batch).view(num_batch + self.output_dim)
+        return self.embedding_net(modality, quantized)(batch).view(num_batch + self.output_dim)
+
+    def fingerprint(self, modality):
+        """Returns a hash of the weights of the embedding_net of modality and of its preprocessing model"""
+        i = self.modalities[modality]
+        h = hashlib.sha1(str(self.output_dim).encode())
+        h.update(net_fingerprint(self.embedding_nets[i]).encode())
+        # Quantized nets compute different embeddings than the float nets
+        h.update(str(self.quantized).encode())
+        if type(self.preprocessors[i]) == str:
+            h.update(self.engine.models[self.preprocessors[i]].fingerprint(modality).encode())
+        return h.hexdigest()
+
+    def chain_fingerprint(self, modality):
+        """Returns a hash of the weights of every net get_embedding runs for modality, see freeze"""
+        h = hashlib.sha1(self.fingerprint(modality).encode())
+        preprocessor = self.preprocessors[self.modalities[modality]]
+        if isinstance(preprocessor, torch.nn.Module):
+            h.update(net_fingerprint(preprocessor).encode())
+        return h.hexdigest()
 
     def get_info(self):
         """
@@ -130,6 +351,13 @@ class Model():
             "desc": self.desc
         }
         info["preprocessors"] = [p if type(p) == str else None for p in self.preprocessors]
+        info["inference_mode"] = self.inference_mode
+        # Graphs of the onnx backend are not TorchScript graphs
+        info["frozen"] = [m for m, i in self.modalities.items() if self.frozen_nets[i] is not None] if self.backend == "torch" else []
+        info["frozen_fingerprints"] = {m: self.frozen_fingerprints[self.modalities[m]] for m in info["frozen"]}
+        info["quantized"] = self.quantized
+        info["backend"] = self.backend
+        info["onnx_threads"] = self.onnx_threads
         model_dir = os.path.normpath(f"{self.engine.model_dir}/{self.name}/")
         embedding_net_dir = os.path.normpath(f"{model_dir}/embedding_nets/")
         if not os.path.isdir(embedding_net_dir):
@@ -137,5 +365,20 @@ class Model():
         with open(f"{model_dir}/model.txt", "w+") as f:
             f.write(json.dumps(info))
         for modality_index, embedding_net in enumerate(self.embedding_nets):
+            if isinstance(embedding_net, OnnxNet):
+                # Exported by export_onnx, the pickled module is kept as it is
+                continue
             with open(f"{embedding_net_dir}/{model_modalities[modality_index]}.nn.pkl", "wb+") as f:
                 pickle.dump(embedding_net, f)
+        for modality in info["frozen"]:
+            torch.jit.save(self.frozen_nets[self.modalities[modality]], f"{model_dir}/{modality}.frozen.pt")
+        if self.quantized:
+            self.save_quantized()
+
+    def save_quantized(self):
+        """Caches the quantized embedding nets next to the float embedding nets, with the fingerprint of the weights they came from"""
+        embedding_net_dir = os.path.normpath(f"{self.engine.model_dir}/{self.name}/embedding_nets/")
+        for modality, i in self.modalities.items():
+            if self.quantized_nets[i] is not None:
+                cache = {"fingerprint": net_fingerprint(self.embedding_nets[i]), "net": self.quantized_nets[i]}
+                torch.save(cache, f"{embedding_net_dir}/{modality}.int8.pt")
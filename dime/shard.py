@@ -0,0 +1,74 @@
+import faiss
+import os
+
+def read_faiss_index(path, binary = False, io_flags = 0):
+    """Reads a FAISS index written by write_faiss_index"""
+    if binary:
+        return faiss.read_index_binary(path, io_flags)
+    return faiss.read_index(path, io_flags)
+
+def write_faiss_index(index, path, binary = False):
+    """
+    Writes a FAISS index to path
+
+    Written under a temporary name first so a memory-mapped file at path is never overwritten
+    """
+    if binary:
+        faiss.write_index_binary(index, f"{path}.tmp")
+    else:
+        faiss.write_index(index, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+def shard_worker(conn, binary):
+    """
+    Serves one shard of a ShardedIndex in its own process
+
+    Only imports FAISS so that worker processes start quickly and stay small
+
+    Every message received on conn is a (command, args) tuple, and every reply is an (error, result) tuple:
+        ("init", bytes):                    Start an empty shard from a serialized, trained FAISS id map
+        ("read", (path, io_flags)):         Read the shard from path, returns (d, ntotal, metric_type, has_id_map)
+        ("write", path):                    Write the shard to path
+        ("add", (embeddings, ids)):         Add embeddings under their stable ids
+        ("remove", ids):                    Remove ids from the shard, returns the number of embeddings removed
+        ("search", (embeddings, n)):        Returns (distances, ids) of the n closest neighbors in the shard
+        ("ntotal", None):                   Returns the number of embeddings in the shard
+        ("close", None):                    Stops the worker
+
+    Parameters:
+    conn (multiprocessing.Connection): Connection to the ShardedIndex
+    binary (bool): True if the shard holds bit-packed embeddings
+    """
+    index = None
+    while True:
+        try:
+            command, args = conn.recv()
+        except EOFError:
+            # The ShardedIndex went away without closing the shard
+            break
+        try:
+            result = None
+            if "init" == command:
+                index = faiss.deserialize_index_binary(args) if binary else faiss.deserialize_index(args)
+            elif "read" == command:
+                index = read_faiss_index(args[0], binary, args[1])
+                result = (index.d, index.ntotal, None if binary else index.metric_type, hasattr(index, "id_map"))
+            elif "write" == command:
+                write_faiss_index(index, args, binary)
+            elif "add" == command:
+                index.add_with_ids(*args)
+            elif "remove" == command:
+                result = index.remove_ids(args)
+            elif "search" == command:
+                result = index.search(*args)
+            elif "ntotal" == command:
+                result = index.ntotal
+            elif "close" == command:
+                conn.send((None, None))
+                break
+            else:
+                raise RuntimeError(f"Unknown shard command '{command}'")
+            conn.send((None, result))
+        except Exception as e:
+            conn.send((e, None))
+    conn.close()
@@ -0,0 +1,523 @@
+import json
+import numpy as np
+import os
+import shutil
+import zlib
+
+from dime.utils import list_batches, load_batch, load_batch_ids
+
+HEADER_SIZE = 256
+MAGIC = b"DIMESTOR"
+
+class ArrayStore():
+    def __init__(self, path, shape, dtype):
+        """
+        Contiguous, append-only file of equally shaped rows, read back with np.memmap
+
+        The file starts with a HEADER_SIZE byte header holding the row shape, dtype and number of rows,
+        followed by the rows. Space is preallocated past the last row, so appending rarely grows the file,
+        and the header is only updated after the rows are written, so an interrupted append is never visible
+
+        Parameters:
+        path (str): Path of the store file, created on the first append or reserve
+        shape (tuple): Shape of each row
+        dtype (str): Numpy dtype of the rows
+        """
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.row_size = int(np.prod(self.shape, dtype = "int64")) * self.dtype.itemsize
+        self.rows = 0
+        if os.path.isfile(path):
+            header = self.read_header()
+            if tuple(header["shape"]) != self.shape or np.dtype(header["dtype"]) != self.dtype:
+                raise RuntimeError(f"Store '{path}' holds rows of shape {tuple(header['shape'])} and dtype '{header['dtype']}', " + \
+                    f"expected {self.shape} and '{self.dtype}'")
+            self.rows = header["rows"]
+
+    def read_header(self):
+        """Returns the header of the store file as a dictionary"""
+        return read_header(self.path)
+
+    def write_header(self, f):
+        header = json.dumps({"dtype": self.dtype.str, "shape": list(self.shape), "rows": self.rows}).encode()
+        assert len(MAGIC) + len(header) <= HEADER_SIZE, f"Row shape {self.shape} too large for store header"
+        f.seek(0)
+        f.write(MAGIC + header.ljust(HEADER_SIZE - len(MAGIC)))
+
+    def capacity(self):
+        """Returns the number of rows the store file has space for"""
+        if not os.path.isfile(self.path) or not self.row_size:
+            return 0
+        return (os.path.getsize(self.path) - HEADER_SIZE) // self.row_size
+
+    def reserve(self, capacity):
+        """Preallocates space for at least capacity rows"""
+        if not os.path.isfile(self.path):
+            with open(self.path, "wb") as f:
+                self.write_header(f)
+        if capacity > self.capacity():
+            with open(self.path, "r+b") as f:
+                f.truncate(HEADER_SIZE + capacity * self.row_size)
+
+    def append(self, rows):
+        """
+        Appends rows to the store, growing the file geometrically if it is full
+
+        Returns:
+        int: Index of the first appended row
+        """
+        rows = np.ascontiguousarray(rows, dtype = self.dtype).reshape((-1,) + self.shape)
+        start = self.rows
+        if start + len(rows) > self.capacity():
+            self.reserve(max(start + len(rows), 2 * self.capacity(), 1024))
+        with open(self.path, "r+b") as f:
+            f.seek(HEADER_SIZE + start * self.row_size)
+            rows.tofile(f)
+            f.flush()
+            self.rows = start + len(rows)
+            self.write_header(f)
+        return start
+
+    def truncate(self, rows):
+        """Drops every row after the first rows, keeping the preallocated space"""
+        assert rows <= self.rows, f"Cannot truncate store of {self.rows} rows to {rows} rows"
+        if rows == self.rows:
+            # Leaves the file, and its modification time, untouched
+            return
+        self.rows = rows
+        if os.path.isfile(self.path):
+            with open(self.path, "r+b") as f:
+                self.write_header(f)
+
+    def array(self):
+        """Returns a read-only memory map of the rows"""
+        if not self.rows:
+            return np.zeros((0,) + self.shape, dtype = self.dtype)
+        return np.memmap(self.path, dtype = self.dtype, mode = "r", offset = HEADER_SIZE, shape = (self.rows,) + self.shape)
+
+    def sync(self):
+        """Flushes the store file to disk"""
+        if os.path.isfile(self.path):
+            with open(self.path, "r+b") as f:
+                os.fsync(f.fileno())
+
+    def mtime(self):
+        """Returns the modification time of the store file, 0 if it does not exist"""
+        return os.path.getmtime(self.path) if os.path.isfile(self.path) else 0
+
+    def __len__(self):
+        return self.rows
+
+class EmbeddingStore():
+    def __init__(self, embedding_dir, dim, post_processing = ""):
+        """
+        Saved embeddings of one (model, dataset, post_processing), along with their stable ids
+
+        Embeddings are kept in embedding_dir/embeddings.store and their ids in embedding_dir/ids.store,
+        binarized embeddings are kept bit-packed. Embedding directories written as batch_N.npy files
+        are migrated the first time they are opened
+
+        Parameters:
+        embedding_dir (str): Directory of the embeddings
+        dim (tuple): Shape of each embedding
+        post_processing (str): "binarized" if embeddings are binarized
+        """
+        self.embedding_dir = embedding_dir
+        self.dim = tuple(dim)
+        self.post_processing = post_processing
+        self.binary = "binarized" == post_processing
+        if list_batches(embedding_dir) and not os.path.isfile(f"{embedding_dir}/embeddings.store"):
+            migrate_batches(embedding_dir, self.dim, post_processing)
+        self.embeddings = ArrayStore(f"{embedding_dir}/embeddings.store", *embedding_row(self.dim, post_processing))
+        self.ids = ArrayStore(f"{embedding_dir}/ids.store", (), "int64")
+
+    def reserve(self, capacity):
+        """Preallocates space for at least capacity embeddings"""
+        self.ids.reserve(capacity)
+        self.embeddings.reserve(capacity)
+
+    def append(self, embeddings, ids):
+        """Appends embeddings with their stable ids, binarized embeddings must already be packed by pack_embeddings"""
+        if self.binary and embeddings.dtype != np.uint8:
+            raise RuntimeError("Binarized embeddings must be packed with pack_embeddings and the index threshold before they are stored")
+        if len(self.ids) != len(self.embeddings):
+            self.truncate(len(self))
+        self.ids.append(ids)
+        self.embeddings.append(embeddings)
+
+    def truncate(self, rows):
+        """Drops every embedding after the first rows"""
+        self.embeddings.truncate(min(rows, len(self.embeddings)))
+        self.ids.truncate(min(rows, len(self.ids)))
+
+    def get(self, start = 0, stop = None, packed = False):
+        """
+        Returns the embeddings and ids of rows start to stop
+
+        Float and packed embeddings are memory-mapped views, unpacked binarized embeddings are copied
+
+        Returns:
+        arraylike: Embeddings
+        arraylike: Stable ids of the embeddings
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        embeddings = self.embeddings.array()[start:stop]
+        if self.binary and not packed:
+            embeddings = np.unpackbits(embeddings, axis = -1).astype("float32")
+        return embeddings, self.ids.array()[start:stop]
+
+    def find(self, ids):
+        """Returns the rows holding the embeddings of ids, or None if any of ids is not saved"""
+        return find_rows(self.ids.array()[:len(self)], ids)
+
+    def missing(self, ids):
+        """Returns a mask of the ids whose embeddings are not saved"""
+        return ~np.isin(ids, self.ids.array()[:len(self)])
+
+    def take(self, rows, packed = False):
+        """Returns a copy of the embeddings of rows"""
+        embeddings = self.embeddings.array()[rows]
+        if self.binary and not packed:
+            embeddings = np.unpackbits(embeddings, axis = -1).astype("float32")
+        return embeddings
+
+    def sample(self, n, packed = False):
+        """Returns up to n embeddings drawn at random, in random order"""
+        embeddings = self.take(np.sort(np.random.permutation(len(self))[:n]), packed = packed)
+        return embeddings[np.random.permutation(len(embeddings))]
+
+    def checksum(self, start, stop):
+        """Returns the CRC-32 of the saved embeddings and ids of rows start to stop"""
+        embeddings, ids = self.get(start, stop, packed = True)
+        return zlib.crc32(np.ascontiguousarray(embeddings).tobytes(), zlib.crc32(np.ascontiguousarray(ids).tobytes()))
+
+    def sync(self):
+        """Flushes the embeddings and ids to disk"""
+        self.ids.sync()
+        self.embeddings.sync()
+
+    def mtime(self):
+        """Returns the time the embeddings were last changed"""
+        return max(self.embeddings.mtime(), self.ids.mtime())
+
+    def __len__(self):
+        # An append interrupted between the ids and the embeddings leaves extra ids
+        return min(len(self.embeddings), len(self.ids))
+
+class TensorCache():
+    def __init__(self, cache_dir, shape, shard_size = 4096):
+        """
+        Decoded uint8 tensors of a dataset's items, along with their stable ids, see ImageDataset.get_data
+
+        Tensors are kept in memory-mapped shards of shard_size items, cache_dir/shard_N.store, and their ids
+        in cache_dir/ids.store. A shard is only appended to after every shard before it is full
+
+        Parameters:
+        cache_dir (str): Directory of the cache
+        shape (tuple): Shape of each tensor
+        shard_size (int): Number of tensors per shard
+        """
+        self.cache_dir = cache_dir
+        self.shape = tuple(shape)
+        self.shard_size = shard_size
+        self.ids = ArrayStore(f"{cache_dir}/ids.store", (), "int64")
+        self.shards = []
+        while os.path.isfile(self.shard_path(len(self.shards))):
+            self.shards.append(ArrayStore(self.shard_path(len(self.shards)), self.shape, "uint8"))
+
+    def shard_path(self, shard):
+        return f"{self.cache_dir}/shard_{shard}.store"
+
+    def append(self, tensors, ids):
+        """Appends uint8 tensors with their stable ids"""
+        tensors = np.ascontiguousarray(tensors, dtype = "uint8")
+        if len(self.ids) != self.num_tensors():
+            self.truncate(len(self))
+        start = 0
+        while start < len(tensors):
+            if not self.shards or len(self.shards[-1]) >= self.shard_size:
+                shard = ArrayStore(self.shard_path(len(self.shards)), self.shape, "uint8")
+                shard.reserve(self.shard_size)
+                self.shards.append(shard)
+            stop = start + self.shard_size - len(self.shards[-1])
+            self.shards[-1].append(tensors[start:stop])
+            start = stop
+        self.ids.append(ids)
+
+    def truncate(self, rows):
+        """Drops every tensor after the first rows"""
+        self.ids.truncate(min(rows, len(self.ids)))
+        for i, shard in enumerate(self.shards):
+            shard.truncate(min(max(rows - i * self.shard_size, 0), len(shard)))
+
+    def find(self, ids):
+        """Returns the rows holding the tensors of ids, or None if any of ids is not cached"""
+        return find_rows(self.ids.array()[:len(self)], ids)
+
+    def missing(self, ids):
+        """Returns a mask of the ids that are not cached"""
+        return ~np.isin(ids, self.ids.array()[:len(self)])
+
+    def take(self, rows):
+        """Returns a copy of the tensors of rows"""
+        rows = np.asarray(rows, dtype = "int64")
+        tensors = np.empty((len(rows),) + self.shape, dtype = "uint8")
+        shards = rows // self.shard_size
+        for shard in np.unique(shards):
+            mask = shards == shard
+            tensors[mask] = self.shards[shard].array()[rows[mask] - shard * self.shard_size]
+        return tensors
+
+    def num_tensors(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __len__(self):
+        # An append interrupted between the tensors and the ids leaves extra tensors
+        return min(self.num_tensors(), len(self.ids))
+
+class VectorStore():
+    def __init__(self, prefix, dim = None):
+        """
+        Vectors of a vocabulary of string keys, as one contiguous matrix memory-mapped from disk, see TextDataset
+
+        Made of 4 ArrayStores:
+            <prefix>.vectors.store: float32 matrix with one row per key
+            <prefix>.keys.store:    UTF-8 bytes of every key, one after the other
+            <prefix>.offsets.store: End offset of each key in keys.store
+            <prefix>.table.store:   Open addressing hash table from the CRC-32 of a key to its row, -1 marks empty slots,
+                                    the first entry is the number of keys the table was built for
+
+        Parameters:
+        prefix (str): Path prefix of the store files
+        dim (tuple or int): Shape of each vector, read from the store files if None
+        """
+        self.prefix = prefix
+        if dim is None:
+            dim = read_header(f"{prefix}.vectors.store")["shape"]
+        self.dim = tuple(int(d) for d in np.atleast_1d(dim))
+        self.vector_store = ArrayStore(f"{prefix}.vectors.store", self.dim, "float32")
+        self.key_store = ArrayStore(f"{prefix}.keys.store", (), "uint8")
+        self.offset_store = ArrayStore(f"{prefix}.offsets.store", (), "int64")
+        self.table_store = ArrayStore(f"{prefix}.table.store", (), "int64")
+        self.map()
+        if len(self) and (not len(self.table) or self.table[0] != len(self)):
+            # Keys were appended without finishing the store
+            self.finish()
+
+    @staticmethod
+    def exists(prefix):
+        """Returns True if a store was written at prefix"""
+        return os.path.isfile(f"{prefix}.offsets.store")
+
+    def map(self):
+        """Memory-maps the store files, after they were written"""
+        self.vectors = self.vector_store.array()
+        self.keys = self.key_store.array()
+        self.offsets = self.offset_store.array()
+        self.table = self.table_store.array()
+
+    def reserve(self, capacity):
+        """Preallocates space for at least capacity vectors"""
+        self.vector_store.reserve(capacity)
+        self.offset_store.reserve(capacity)
+
+    def append(self, keys, vectors):
+        """Appends keys and their vectors, keys can only be looked up by row once finish is called"""
+        encoded = [key.encode() for key in keys]
+        ends = len(self.key_store) + np.cumsum([len(key) for key in encoded], dtype = "int64")
+        self.vector_store.append(np.asarray(vectors, dtype = "float32"))
+        self.key_store.append(np.frombuffer(b"".join(encoded), dtype = "uint8"))
+        # The offsets are written last, they define the number of keys in the store
+        self.offset_store.append(ends)
+
+    def truncate(self, rows):
+        """Drops every key after the first rows"""
+        self.offset_store.truncate(rows)
+        self.key_store.truncate(int(self.offset_store.array()[rows - 1]) if rows else 0)
+        self.vector_store.truncate(rows)
+        self.table_store.truncate(0)
+        self.map()
+
+    def finish(self):
+        """Builds the hash table of the keys and memory-maps the store"""
+        self.map()
+        size = 8
+        while size < 2 * len(self):
+            size *= 2
+        table = np.full(size + 1, -1, dtype = "int64")
+        table[0] = len(self)
+        keys = self.keys.tobytes()
+        start = 0
+        for row, end in enumerate(self.offsets.tolist()):
+            slot = zlib.crc32(keys[start:end]) & (size - 1)
+            while table[slot + 1] != -1:
+                slot = (slot + 1) & (size - 1)
+            table[slot + 1] = row
+            start = end
+        table_store = ArrayStore(f"{self.table_store.path}.tmp", (), "int64")
+        table_store.truncate(0)
+        table_store.append(table)
+        table_store.sync()
+        os.replace(table_store.path, self.table_store.path)
+        self.table_store = ArrayStore(self.table_store.path, (), "int64")
+        self.map()
+
+    def key(self, row):
+        """Returns the key of row"""
+        start = int(self.offsets[row - 1]) if row else 0
+        return self.keys[start:int(self.offsets[row])].tobytes().decode()
+
+    def row(self, key):
+        """Returns the row of key, or -1 if key is not in the store"""
+        encoded = key.encode()
+        size = len(self.table) - 1
+        if size <= 0:
+            return -1
+        slot = zlib.crc32(encoded) & (size - 1)
+        while self.table[slot + 1] != -1:
+            row = int(self.table[slot + 1])
+            start = int(self.offsets[row - 1]) if row else 0
+            if self.keys[start:int(self.offsets[row])].tobytes() == encoded:
+                return row
+            slot = (slot + 1) & (size - 1)
+        return -1
+
+    def __len__(self):
+        return min(len(self.offset_store), len(self.vector_store))
+
+class BuildManifest():
+    def __init__(self, embedding_dir):
+        """
+        Record of the build that wrote the EmbeddingStore of embedding_dir, used to resume interrupted builds
+
+        embedding_dir/manifest.json holds the inputs of the build (batch size, dataset and model fingerprints, ...),
+        the number of committed rows and whether the build completed, and is only ever replaced atomically.
+        embedding_dir/batches.store holds the (start, stop, checksum) of every committed batch
+
+        Parameters:
+        embedding_dir (str): Directory of the embeddings
+        """
+        self.path = f"{embedding_dir}/manifest.json"
+        self.batches = ArrayStore(f"{embedding_dir}/batches.store", (3,), "int64")
+        self.info = None
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as f:
+                self.info = json.loads(f.read())
+
+    def start(self, inputs, rows = 0):
+        """Starts a new build from inputs, over the first rows of the store if they were saved without a manifest"""
+        self.info = {"inputs": inputs, "rows": rows, "complete": False}
+        self.batches.truncate(0)
+        self.write()
+
+    def changed_inputs(self, inputs, keys):
+        """Returns the keys of inputs that differ from the inputs of the recorded build"""
+        return [k for k in keys if self.info["inputs"].get(k) != inputs.get(k)]
+
+    def verified_rows(self, store):
+        """
+        Returns the number of rows of store that can be resumed from
+
+        Committed batches are checked from the last one backwards, and rows are kept up to the last batch whose checksum matches
+        """
+        batches = self.batches.array()
+        batches = batches[batches[:, 1] <= self.info["rows"]]
+        for start, stop, checksum in batches[::-1]:
+            if stop <= len(store) and store.checksum(start, stop) == checksum:
+                return int(stop)
+        return int(batches[0][0]) if len(batches) else min(self.info["rows"], len(store))
+
+    def truncate(self, rows):
+        """Forgets every batch committed after the first rows"""
+        batches = self.batches.array()
+        self.batches.truncate(int(np.sum(batches[:, 1] <= rows)))
+        self.info["rows"] = rows
+        self.info["complete"] = False
+        self.write()
+
+    def commit(self, store, start, stop):
+        """Records rows start to stop of store as saved, once they are flushed to disk"""
+        self.batches.append([start, stop, store.checksum(start, stop)])
+        store.sync()
+        self.batches.sync()
+        self.info["rows"] = stop
+        self.write()
+
+    def update(self, inputs):
+        """Updates inputs of the recorded build, after the store was changed to match them"""
+        self.info["inputs"].update(inputs)
+        self.write()
+
+    def finish(self):
+        """Marks the build as complete"""
+        self.info["complete"] = True
+        self.write()
+
+    def write(self):
+        with open(f"{self.path}.tmp", "w") as f:
+            f.write(json.dumps(self.info))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{self.path}.tmp", self.path)
+
+def read_header(path):
+    """Returns the header of the store file at path as a dictionary, see ArrayStore"""
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    if header[:len(MAGIC)] != MAGIC:
+        raise RuntimeError(f"'{path}' is not a store file")
+    return json.loads(header[len(MAGIC):].decode().strip())
+
+def find_rows(saved_ids, ids):
+    """Returns the rows of saved_ids holding ids, or None if any of ids is not in saved_ids"""
+    order = np.argsort(saved_ids, kind = "stable")
+    positions = np.minimum(np.searchsorted(saved_ids[order], ids), max(len(order) - 1, 0))
+    if not len(order) or np.any(saved_ids[order[positions]] != ids):
+        return None
+    return order[positions]
+
+def embedding_row(dim, post_processing = ""):
+    """Returns the row shape and dtype embeddings of shape dim are stored with, binarized embeddings are bit-packed"""
+    if "binarized" == post_processing:
+        return (dim[0] // 8,), "uint8"
+    return tuple(dim), "float32"
+
+def migrate_batches(embedding_dir, dim, post_processing = ""):
+    """
+    Moves embeddings saved as batch_N.npy files (and their ids/batch_N.npy) into an EmbeddingStore
+
+    The store is written under temporary names and only replaces the batch files once it is complete
+
+    Parameters:
+    embedding_dir (str): Directory of the embeddings
+    dim (tuple): Shape of each embedding
+    post_processing (str): "binarized" if embeddings are binarized
+    """
+    for f in ["embeddings.store.tmp", "ids.store.tmp"]:
+        if os.path.isfile(f"{embedding_dir}/{f}"):
+            os.remove(f"{embedding_dir}/{f}")
+    embedding_store = ArrayStore(f"{embedding_dir}/embeddings.store.tmp", *embedding_row(dim, post_processing))
+    id_store = ArrayStore(f"{embedding_dir}/ids.store.tmp", (), "int64")
+
+    filenames = list_batches(embedding_dir)
+    offset = 0
+    for filename in filenames:
+        embeddings = load_batch(filename, embedding_dir, dim, post_processing = post_processing)
+        # Batches saved without ids hold consecutive items
+        ids = load_batch_ids(filename, embedding_dir)
+        if ids is None:
+            ids = np.arange(offset, offset + len(embeddings), dtype = "int64")
+        offset += len(embeddings)
+        id_store.append(ids)
+        embedding_store.append(embeddings)
+
+    # embeddings.store is replaced last, its existence marks the migration as done
+    id_store.reserve(0)
+    embedding_store.reserve(0)
+    os.replace(id_store.path, f"{embedding_dir}/ids.store")
+    os.replace(embedding_store.path, f"{embedding_dir}/embeddings.store")
+    for filename in filenames:
+        os.remove(f"{embedding_dir}/{filename}")
+    if os.path.isdir(f"{embedding_dir}/ids"):
+        shutil.rmtree(f"{embedding_dir}/ids")
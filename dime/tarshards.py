@@ -0,0 +1,128 @@
+import io
+import numpy as np
+import os
+import pickle
+import tarfile
+import torch
+from PIL import Image
+from torchvision.datasets import ImageFolder
+
+INDEX_FILE = "index.pkl"
+
+class TarShards(torch.utils.data.Dataset):
+    def __init__(self, shard_dir, index, transform = None):
+        """
+        Images stored in the tar shards of shard_dir, read by offset, see TarImageDataset
+
+        Items are read in order from one shard after another, so a DataLoader over contiguous positions
+        reads every shard sequentially. Shard files are opened on first use by each worker process
+
+        Parameters:
+        shard_dir (str): Directory of the tar shards and their index
+        index (dict): Offset index of the shards, see index_tar_shards
+        transform (callable): transforms to apply to images
+        """
+        self.shard_dir = shard_dir
+        self.shards = index["shards"]
+        self.names = index["names"]
+        self.labels = index["labels"]
+        self.classes = index["classes"]
+        self.offsets = index["offsets"]
+        self.transform = transform
+        self.files = {}
+
+    def read(self, position):
+        """Returns the bytes of the item at position"""
+        shard, offset, size = (int(x) for x in self.offsets[position])
+        if shard not in self.files:
+            self.files[shard] = open(os.path.join(self.shard_dir, self.shards[shard]), "rb")
+        # Positional reads, so threads can share a shard file
+        return os.pread(self.files[shard].fileno(), size, offset)
+
+    def __getitem__(self, position):
+        image = Image.open(io.BytesIO(self.read(position))).convert("RGB")
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.labels[position]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        # Open shard files are not shared with worker processes
+        state = self.__dict__.copy()
+        state["files"] = {}
+        return state
+
+def index_tar_shards(shard_dir):
+    """
+    Builds the offset index of the tar shards in shard_dir and saves it to shard_dir/index.pkl
+
+    Every regular file in the shards is an item, named by its path inside the shard and labelled
+    by its top-level directory, the same way ImageFolder labels images
+
+    Returns:
+    dict: {"shards", "names", "labels", "classes", "offsets"}, where offsets holds the (shard, offset, size) of each item
+    """
+    shards = sorted(f for f in os.listdir(shard_dir) if f.endswith(".tar"))
+    names, directories, offsets = [], [], []
+    for shard, filename in enumerate(shards):
+        with tarfile.open(os.path.join(shard_dir, filename), "r:") as tar:
+            for member in tar:
+                if member.isfile():
+                    names.append(member.name)
+                    directories.append(member.name.split("/")[0] if "/" in member.name else "")
+                    offsets.append((shard, member.offset_data, member.size))
+    classes = sorted(set(directories))
+    class_to_idx = {c: i for i, c in enumerate(classes)}
+    index = {
+        "shards": shards,
+        "names": names,
+        "labels": [class_to_idx[d] for d in directories],
+        "classes": classes,
+        "offsets": np.array(offsets, dtype = "int64").reshape(-1, 3)
+    }
+    with open(os.path.join(shard_dir, f"{INDEX_FILE}.tmp"), "wb") as f:
+        pickle.dump(index, f)
+    os.replace(os.path.join(shard_dir, f"{INDEX_FILE}.tmp"), os.path.join(shard_dir, INDEX_FILE))
+    return index
+
+def load_tar_index(shard_dir):
+    """Returns the offset index of the tar shards in shard_dir, building it if it was not saved"""
+    if os.path.isfile(os.path.join(shard_dir, INDEX_FILE)):
+        with open(os.path.join(shard_dir, INDEX_FILE), "rb") as f:
+            return pickle.load(f)
+    return index_tar_shards(shard_dir)
+
+def convert_image_folder(image_dir, shard_dir, shard_size = 1 << 30):
+    """
+    Writes the images of an ImageFolder layout (image_dir/<class>/<image>) into tar shards, then indexes them
+
+    Images are written in ImageFolder order under their path relative to image_dir, so a TarImageDataset of
+    shard_dir holds the same items, in the same order, as an ImageDataset of image_dir
+
+    Parameters:
+    image_dir (str): Directory of class directories of images
+    shard_dir (str): Directory the shards are written to, as shard_000000.tar, shard_000001.tar, ...
+    shard_size (int): Number of bytes after which a new shard is started
+
+    Returns:
+    dict: Offset index of the shards, see index_tar_shards
+    """
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    assert not any(f.endswith(".tar") for f in os.listdir(shard_dir)), f"'{shard_dir}' already holds tar shards"
+    tar, shard, written = None, 0, 0
+    try:
+        for filename, _ in ImageFolder(image_dir).samples:
+            if tar is None or written >= shard_size:
+                if tar is not None:
+                    tar.close()
+                    shard += 1
+                tar, written = tarfile.open(os.path.join(shard_dir, f"shard_{shard:06d}.tar"), "w"), 0
+            tar.add(filename, arcname = os.path.relpath(filename, image_dir), recursive = False)
+            written += os.path.getsize(filename)
+    finally:
+        if tar is not None:
+            tar.close()
+    return index_tar_shards(shard_dir)
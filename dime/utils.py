@@ -1,81 +1,228 @@
-import torch
+import queue
+import threading
 import warnings
 import numpy as np
 import os
+from collections.abc import MutableMapping, Sequence
 
-class BatchKeySampler(torch.utils.data.Sampler):
-    def __init__(self, data_source, batch_size, drop_last = False):
-        """Samples keys of a dictionary sequentially by dict.keys()
+class PackedStrings(Sequence):
+    def __init__(self, buffer = None, offsets = None, prefix = ""):
+        """
+        Read-only list of strings packed into one UTF-8 buffer, instead of one Python string each
 
         Parameters:
-            data_source (Dataset): dataset to sample from
+            buffer (arraylike): uint8 array of the UTF-8 bytes of every string, one after the other
+            offsets (arraylike): int64 array of the end offset of each string in buffer
+            prefix (str): Prepended to every string read, e.g. a directory shared by paths
+        """
+        self.buffer = np.zeros(0, dtype="uint8") if buffer is None else np.asarray(buffer, dtype="uint8")
+        self.offsets = np.zeros(0, dtype="int64") if offsets is None else np.asarray(offsets, dtype="int64")
+        self.prefix = prefix
+
+    @staticmethod
+    def pack(strings, prefix = ""):
+        """Returns PackedStrings of a list of strings"""
+        encoded = [s.encode() for s in strings]
+        offsets = np.cumsum([len(s) for s in encoded], dtype="int64")
+        return PackedStrings(np.frombuffer(b"".join(encoded), dtype="uint8"), offsets, prefix)
+
+    def extend(self, strings):
+        """Returns PackedStrings of these strings followed by strings"""
+        other = PackedStrings.pack(strings)
+        end = self.offsets[-1] if len(self.offsets) else 0
+        return PackedStrings(np.concatenate([self.buffer, other.buffer]), np.concatenate([self.offsets, other.offsets + end]), self.prefix)
+
+    def take(self, keep):
+        """Returns PackedStrings of the strings selected by the boolean mask keep, sliced from the buffer without decoding them"""
+        keep = np.asarray(keep, dtype=bool)
+        lengths = np.diff(self.offsets, prepend=0)
+        return PackedStrings(self.buffer[np.repeat(keep, lengths)], np.cumsum(lengths[keep], dtype="int64"), self.prefix)
+
+    def find(self, strings):
         """
-        self.data_source = data_source.keys()
-        self.batch_size = batch_size
-        self.drop_last = drop_last
+        Returns the position of each of strings, -1 for strings that are not in the list
+
+        Each string is searched for in the buffer, so the strings of the list are never decoded
+        """
+        data = self.buffer.tobytes()
+        starts = self.offsets - np.diff(self.offsets, prepend=0)
+        positions = np.full(len(strings), -1, dtype="int64")
+        for k, string in enumerate(strings):
+            if not string.startswith(self.prefix):
+                continue
+            needle = string[len(self.prefix):].encode()
+            start = data.find(needle)
+            while start >= 0:
+                # Only a match spanning a whole string counts
+                i = int(np.searchsorted(starts, start))
+                if i < len(starts) and starts[i] == start and self.offsets[i] == start + len(needle):
+                    positions[k] = i
+                    break
+                start = data.find(needle, start + 1)
+        return positions
+
+    def raw(self, i):
+        """Returns string i without the prefix"""
+        start = self.offsets[i - 1] if i else 0
+        return self.buffer[start:self.offsets[i]].tobytes().decode()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.prefix + self.raw(i)
+
+    def __len__(self):
+        return len(self.offsets)
+
+class LazyDict(MutableMapping):
+    def __init__(self, loader):
+        """
+        Dictionary whose deferred values are loaded on first access
+
+        Parameters:
+            loader (callable): called with a deferred key, returns its value
+        """
+        self.loader = loader
+        self.store = {}
+        self.deferred = []
+        self.lock = threading.RLock()
+
+    def defer(self, key):
+        """Records key without loading its value"""
+        if key not in self:
+            self.deferred.append(key)
+
+    def loaded(self):
+        """Returns a dictionary of the values that have been loaded so far"""
+        return dict(self.store)
+
+    def __getitem__(self, key):
+        if key in self.deferred:
+            with self.lock:
+                if key in self.deferred:
+                    self.store[key] = self.loader(key)
+                    self.deferred.remove(key)
+        return self.store[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self.deferred:
+                self.deferred.remove(key)
+            self.store[key] = value
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key in self.deferred:
+                self.deferred.remove(key)
+            else:
+                del self.store[key]
+
+    def __contains__(self, key):
+        return key in self.store or key in self.deferred
 
     def __iter__(self):
-        batch = []
-        for k in iter(self.data_source):
-            batch.append(k)
-            if len(batch) == self.batch_size:
-                yield batch
-                batch = []
-        if len(batch) > 0 and not self.drop_last:
-            yield batch
+        return iter(list(self.store) + list(self.deferred))
 
     def __len__(self):
-        return len(self.data_source)
+        return len(self.store) + len(self.deferred)
+
+class BackgroundWriter():
+    def __init__(self, write, max_pending = 2):
+        """
+        Calls write on a background thread, in the order items are put
+
+        Parameters:
+            write (callable): called with the arguments of each put
+            max_pending (int): number of items that may wait to be written before put blocks
+        """
+        self.write = write
+        self.queue = queue.Queue(max_pending)
+        self.error = None
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            args = self.queue.get()
+            if args is None:
+                break
+            if self.error is None:
+                try:
+                    self.write(*args)
+                except Exception as e:
+                    self.error = e
+
+    def put(self, *args):
+        """Queues a write, raises the error of an earlier write if it failed"""
+        if self.error is not None:
+            raise self.error
+        self.queue.put(args)
+
+    def close(self):
+        """Waits for every queued write, raises the error of a write if one failed"""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+def list_batches(embedding_dir):
+    """Returns filenames of the saved embedding batches in embedding_dir, sorted by batch number"""
+    if not os.path.isdir(embedding_dir):
+        return []
+    filenames = [f for f in os.listdir(embedding_dir) if f[:6] == "batch_" and f[-4:] == ".npy"]
+    return sorted(filenames, key = lambda f: int(f[6:-4]))
+
+def load_batch_ids(filename, embedding_dir):
+    """Returns the stable ids saved with a batch by save_batch, or None if the batch has no saved ids"""
+    path = os.path.normpath(f"{embedding_dir}/ids/{filename}")
+    if not os.path.isfile(path):
+        return None
+    return np.load(path)
+
+def load_removed_ids(embedding_dir):
+    """Returns the ids of saved embeddings that were removed from the dataset, see save_removed_ids"""
+    path = os.path.normpath(f"{embedding_dir}/removed.npy")
+    if not os.path.isfile(path):
+        return np.zeros(0, dtype="int64")
+    return np.load(path)
+
+def save_removed_ids(embedding_dir, ids):
+    """Marks saved embeddings as removed, they are skipped when embeddings are loaded"""
+    removed = np.union1d(load_removed_ids(embedding_dir), np.asarray(ids, dtype="int64"))
+    np.save(os.path.normpath(f"{embedding_dir}/removed.npy"), removed)
 
 def load_batch(filename, embedding_dir, dim, post_processing=""):
     """
-    Load batch from a filename, does bit unpacking if embeddings are binarized
+    Load batch from a filename, binarized embeddings are kept bit-packed
     
-    Called by SearchEngine.load_embeddings()
+    Called by migrate_batches()
     
     Parameters:
     filename (string): Name of batch .npy file
     embedding_dir (str): Path of the directory containing the embeddings
     dim (tuple): The shape of each embedding should be
-    post_processing (str): "binarized" if embeddings are binarized
+    post_processing (str): "binarized" if embeddings are binarized, they are then loaded as one uint8 row of dim / 8 bytes per embedding
     
     Returns:
     arraylike: loaded batch
     """
     path = os.path.normpath(f"{embedding_dir}/{filename}")
     if post_processing == "binarized":
-        #TODO: confirm this works
-        batch = np.array(np.unpackbits(np.load(path)), dtype="float32")
-        rows = len(batch) // dim
-        batch = batch.reshape(rows, dim)
-    else:
-        batch = np.load(path).astype("float32")
+        return np.load(path).reshape(-1, dim[0] // 8)
+    batch = np.load(path).astype("float32")
 
     if tuple(batch.shape[-len(dim):]) != tuple(dim):
         warnings.warn(f"Loaded batch has dimension {batch.shape[-len(dim):]} but was expected to be {dim}")
 
     return batch
 
-def save_batch(embeddings, filename, embedding_dir, post_processing = ""):
-    """
-    Saves batch into a filename into .npy file
-
-    Does bitpacking if batches are binarized to drastically reduce size of files
-    
-    Parameters:
-    embeddings (arraylike): The batch of embeddings to be saved
-    filename (string): Name of batch .npy file
-    embedding_dir (str): Path of the directory containing the embeddings
-    post_processing (str): "binarized" if embeddings are binarized
-    
-    Returns:
-    None
-    """
-    path = os.path.normpath(f"{embedding_dir}/{filename}.npy")
-    if post_processing == "binarized":
-        np.save(path, np.packbits(embeddings.astype(bool)))
-    else:
-        np.save(path, embeddings.astype('float32'))
+def pack_embeddings(embeddings, threshold = 0.0):
+    """Binarizes float embeddings at threshold and packs each row into uint8 bits"""
+    return np.packbits(embeddings > threshold, axis = -1)
 
 def allowed_file(filename, extensions):
     """Returns true if filename extension is in extensions, otherwise raise RuntimeError"""
@@ -0,0 +1,102 @@
+import argparse
+import io
+import numpy as np
+import os
+import torch
+from collections.abc import Mapping
+
+from dime.store import VectorStore
+
+def load_vocabulary(*paths):
+    """Returns the set of words listed one per line in the files at paths, e.g. NUS-WIDE's TagList1k.txt and Concepts81.txt"""
+    vocabulary = set()
+    for path in paths:
+        with open(path, "r", encoding = "utf-8") as f:
+            vocabulary.update(line.strip() for line in f if line.strip())
+    return vocabulary
+
+def ingest_vectors(vec_path, prefix, vocabulary = None, chunk_size = 65536):
+    """
+    Streams a FastText .vec file into a VectorStore at prefix, see TextDataset and load_vectors
+
+    Lines are parsed into a preallocated matrix of chunk_size rows, which is appended to the store
+    every time it fills up, so the whole file is never held in memory
+
+    Parameters:
+    vec_path (str): Path of the .vec file, a "<count> <dim>" line followed by "<word> <value> ... <value>" lines
+    prefix (str): Path prefix of the store files, any store already at prefix is replaced
+    vocabulary (set of str): Words to keep, every word if None
+    chunk_size (int): Number of vectors parsed before they are appended to the store
+
+    Returns:
+    VectorStore: The written store
+    """
+    with io.open(vec_path, "r", encoding = "utf-8", newline = "\n", errors = "ignore") as f:
+        count, dim = map(int, f.readline().split())
+        directory = os.path.dirname(prefix)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        store = VectorStore(prefix, dim)
+        store.truncate(0)
+        store.reserve(count if vocabulary is None else len(vocabulary))
+
+        keys = []
+        chunk = np.empty((chunk_size, dim), dtype = "float32")
+        for line in f:
+            word, _, values = line.rstrip().partition(" ")
+            if vocabulary is not None and word not in vocabulary:
+                continue
+            values = values.split(" ")
+            if len(values) != dim:
+                # Skips truncated or malformed lines
+                continue
+            chunk[len(keys)] = values
+            keys.append(word)
+            if len(keys) == chunk_size:
+                store.append(keys, chunk)
+                keys = []
+        if keys:
+            store.append(keys, chunk[:len(keys)])
+    store.finish()
+    return store
+
+class VectorMap(Mapping):
+    def __init__(self, store):
+        """
+        Read-only dictionary of words to tensors over a VectorStore, for code written against a dict of tensors
+
+        Parameters:
+        store (VectorStore): Store of the word vectors
+        """
+        self.store = store
+
+    def __getitem__(self, key):
+        row = self.store.row(key)
+        if row < 0:
+            raise KeyError(key)
+        return torch.from_numpy(np.array(self.store.vectors[row]))
+
+    def __contains__(self, key):
+        return self.store.row(key) >= 0
+
+    def __iter__(self):
+        return (self.store.key(row) for row in range(len(self.store)))
+
+    def __len__(self):
+        return len(self.store)
+
+def load_vectors(prefix):
+    """Returns a VectorMap of the VectorStore written at prefix by ingest_vectors"""
+    return VectorMap(VectorStore(prefix))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Streams a FastText .vec file into a VectorStore")
+    parser.add_argument("vec_path", help = "Path of the .vec file")
+    parser.add_argument("prefix", help = "Path prefix of the store files")
+    parser.add_argument("--vocabulary", nargs = "+", help = "Files listing the words to keep, one per line")
+    parser.add_argument("--chunk_size", type = int, default = 65536, help = "Number of vectors parsed per append")
+    args = parser.parse_args()
+
+    vocabulary = load_vocabulary(*args.vocabulary) if args.vocabulary else None
+    store = ingest_vectors(args.vec_path, args.prefix, vocabulary = vocabulary, chunk_size = args.chunk_size)
+    print(f"Wrote {len(store)} vectors of dimension {store.dim} to '{args.prefix}'")
@@ -1,7 +1,9 @@
-from flask import Flask, request, redirect, url_for, send_from_directory, jsonify
+from flask import Flask, request, redirect, url_for, send_file, send_from_directory, jsonify
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+import io
 import os
+import json
 import logging
 
 #TODO fix these
@@ -14,7 +16,9 @@ ALLOWED_EXTENSIONS = {"image": set(["png", "jpg", "jpeg"])}
 
 server = Flask(__name__)
 CORS(server)
-engine = load_engine(ENGINE_NAME)
+# Worker processes of sharded indexes re-import this module as __mp_main__, only the server loads the engine
+if __name__ != "__mp_main__":
+    engine = load_engine(ENGINE_NAME)
 
 def handle_search(request, engine):
     """
@@ -48,20 +52,17 @@ def handle_search(request, engine):
 
     print("Index:", index.name)
 
-    # Process target and convert to tensor
-    if "text" == modality:
-        tensor = engine.target_to_tensor(target, modality = modality)
-    elif "image" == modality:
-        tensor = engine.target_to_tensor(target, modality = modality)
-    elif "dataset" == modality:
+    # Process target, results of repeated targets are served from the engine's cache
+    dataset_name = None
+    if "dataset" == modality:
         dataset = engine.datasets[request.values["dataset_name"]]
+        dataset_name = dataset.name
         modality = dataset.modality
         target = engine.idx_to_target(int(target), dataset.name)
-        tensor = engine.target_to_tensor(target, dataset_name = dataset.name)
-    else:
+    elif modality not in ("text", "image"):
         raise RuntimeError(f"Modality '{modality} not supported")
 
-    dis, idx = engine.search(tensor, modality, index.name, n = num_results, preprocessing=True)
+    dis, idx = engine.search_target(target, modality, index.name, n = num_results, dataset_name = dataset_name, preprocessing=True)
 
     results = {
         "target": target,
@@ -78,6 +79,108 @@ def handle_search(request, engine):
     }
     print("Search handled successfully.")
     return results
+
+def handle_search_all(values, engine):
+    """
+    Search many indexes with one target and return the results of every index
+
+    Parameters:
+    target (str): The target to use as query
+    modality (str): Modality of the target
+    index_names (list of str): Names of the indexes to search in, every valid index of modality if missing
+    num_results (int): Number of results to return per index
+    """
+    print("Handling search of all indexes...")
+
+    target = values["target"]
+    modality = values["modality"]
+    num_results = int(values["num_results"]) if "num_results" in values else 30
+    index_names = values["index_names"] if in_and_true("index_names", values) else None
+
+    dataset_name = None
+    if "dataset" == modality:
+        dataset = engine.datasets[values["dataset_name"]]
+        dataset_name = dataset.name
+        modality = dataset.modality
+        target = engine.idx_to_target(int(target), dataset.name)
+    elif modality not in ("text", "image"):
+        raise RuntimeError(f"Modality '{modality} not supported")
+
+    searches = engine.search_indexes(target, modality, index_names = index_names, n = num_results, dataset_name = dataset_name)
+
+    results = []
+    for index_name, (dis, idx) in searches.items():
+        index = engine.indexes[index_name]
+        results.append({
+            "target": target,
+            "dataset_name": index.dataset_name,
+            "model_name": index.model_name,
+            "index_name": index.name,
+            "post_processing": index.post_processing,
+            "dis": [float(d) for d in dis],
+            "idx": [int(i) for i in idx],
+            "results": [str(x) for x in engine.idx_to_target(idx, index.name)],
+            "modality": modality,
+            "num_results": num_results,
+            "index_modality": index.modality,
+        })
+    print("Search of all indexes handled successfully.")
+    return results
+
+def handle_search_batch(values, engine):
+    """
+    Search through a given index with many targets at once and return arrays of results
+
+    Parameters:
+    targets (list): The targets to use as queries
+    modality (str): Modality of the targets
+    index_name (str): Name of the index to search in
+    num_results (int): Number of results to return per target
+    dataset_name (str): Dataset of the targets if modality is "dataset"
+    """
+    print("Handling batch search...")
+
+    targets = values["targets"]
+    modality = values["modality"]
+    num_results = int(values["num_results"]) if "num_results" in values else 30
+
+    if "index_name" not in values:
+        print("Index name not provided, selecting first text index for tags")
+        index_name = engine.modalities["text"]["index_names"][0]
+        index = engine.indexes[index_name]
+    else:
+        index = engine.indexes[values["index_name"]]
+
+    print("Targets:", len(targets))
+    print("Modality:", modality)
+    print("Index:", index.name)
+
+    dataset_name = None
+    if "dataset" == modality:
+        dataset = engine.datasets[values["dataset_name"]]
+        modality = dataset.modality
+        dataset_name = dataset.name
+        targets = engine.idx_to_target([int(t) for t in targets], dataset.name)
+    elif modality not in ("text", "image"):
+        raise RuntimeError(f"Modality '{modality} not supported")
+
+    dis, idx = engine.search_batch(targets, modality, index.name, n = num_results, dataset_name = dataset_name)
+
+    results = {
+        "targets": [str(t) for t in targets],
+        "dataset_name": index.dataset_name,
+        "model_name": index.model_name,
+        "index_name": index.name,
+        "post_processing": index.post_processing,
+        "dis": [[float(d) for d in row] for row in dis],
+        "idx": [[int(i) for i in row] for row in idx],
+        "results": [[str(x) for x in engine.idx_to_target(row, index.name)] for row in idx],
+        "modality": modality,
+        "num_results": num_results,
+        "index_modality": index.modality,
+    }
+    print("Batch search handled successfully.")
+    return results
             
 @server.route("/uploads/<path:filename>")
 def get_upload(filename):
@@ -85,6 +188,16 @@ def get_upload(filename):
 
 @server.route("/data/<path:filename>")
 def get_data(filename):
+    path = os.path.join(engine.dataset_dir, filename)
+    if not os.path.isfile(path):
+        # Images of tar shard datasets are read from their shard, only loaded datasets holding path are looked in,
+        # so a missing file does not load every dataset of a lazy engine
+        for dataset in engine.datasets.loaded().values():
+            if not hasattr(dataset, "read_target") or not os.path.normpath(path).startswith(dataset.root + os.sep):
+                continue
+            data = dataset.read_target(path)
+            if data is not None:
+                return send_file(io.BytesIO(data), attachment_filename=os.path.basename(path), as_attachment=True)
     return send_from_directory(engine.dataset_dir, filename, as_attachment=True)
 
 @server.route("/file_upload/", methods=["POST"])
@@ -153,6 +266,8 @@ def handle_info():
         info["supported_modalities"] = list(engine.modalities.keys())
     if in_and_true("alive", request.values):
         info["alive"] = True
+    if in_and_true("cache_info", request.values):
+        info["cache_info"] = engine.cache.get_info()
     
     return jsonify(sanitize_dict(info))
 
@@ -179,7 +294,73 @@ def handle_query():
         except Exception as e:
             response["error"] = str(e.__repr__())
     else:
-        response["error"] = "Request missing either 'target' or 'modality'"
+        response = {"error": "Request missing either 'target' or 'modality'"}
+    return jsonify(response)
+
+@server.route("/query_batch", methods=["POST"])
+def handle_query_batch():
+    """
+    Returns results of many targets searched in one batch
+
+    Accepts a JSON body, or form values with "targets" encoded as a JSON list
+
+    request = {
+        "modality",
+        "targets",
+        "index_name",
+        "num_results",
+    }
+    """
+    print("\n\nRECEIVED BATCH QUERY")
+    values = request.get_json(silent = True)
+    if values is None:
+        values = request.values.to_dict()
+        if "targets" in values:
+            values["targets"] = json.loads(values["targets"])
+    if in_and_true("targets", values) and in_and_true("modality", values):
+        response = {
+            "initial_targets": values["targets"],
+            "initial_modality": values["modality"],
+        }
+        try:
+            response["results"] = handle_search_batch(values, engine)
+        except Exception as e:
+            response["error"] = str(e.__repr__())
+    else:
+        response = {"error": "Request missing either 'targets' or 'modality'"}
+    return jsonify(response)
+
+@server.route("/query_all", methods=["POST"])
+def handle_query_all():
+    """
+    Returns results of one target searched in many indexes
+
+    Accepts a JSON body, or form values with "index_names" encoded as a JSON list
+
+    request = {
+        "modality",
+        "target",
+        "index_names",
+        "num_results",
+    }
+    """
+    print("\n\nRECEIVED QUERY OF ALL INDEXES")
+    values = request.get_json(silent = True)
+    if values is None:
+        values = request.values.to_dict()
+        if "index_names" in values:
+            values["index_names"] = json.loads(values["index_names"])
+    if in_and_true("target", values) and in_and_true("modality", values):
+        response = {
+            "initial_target": values["target"],
+            "initial_modality": values["modality"],
+        }
+        try:
+            response["results"] = handle_search_all(values, engine)
+        except Exception as e:
+            response["error"] = str(e.__repr__())
+    else:
+        response = {"error": "Request missing either 'target' or 'modality'"}
     return jsonify(response)
 
 if __name__ == "__main__":
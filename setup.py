@@ -9,13 +9,11 @@ If a re-download is desired, simple change FORCE_DOWNLOAD to True
 
 
 import os
-import io
-import torch
-import pickle
 import tarfile
 import time
 from zipfile import ZipFile
 from util import fetch_and_cache
+from dime.vectors import ingest_vectors, load_vocabulary
 
 FORCE_DOWNLOAD = False
 start_time = time.time()
@@ -83,18 +81,11 @@ with ZipFile('data_zipped/word_vecs.zip', 'r') as data_zipped:
 print("Done extracting FastText word embeddings!")
 
 
-def load_vectors(fname):
-    fin = io.open(fname, 'r', encoding='utf-8', newline='\n', errors='ignore')
-    n, d = map(int, fin.readline().split())
-    data = {}
-    for line in fin:
-        tokens = line.rstrip().split(' ')
-        data[tokens[0]] = torch.FloatTensor(list(map(float, tokens[1:])))
-    return data
-
-print("Processing the word vectors and pickling them... (this might take some time)")
-text_dictionary = load_vectors('data/wiki-news-300d-1M.vec')
-pickle.dump(text_dictionary, open('pickles/word_embeddings/word_embeddings_tensors.p', 'wb'))
+print("Streaming the word vectors into vector stores... (this might take some time)")
+# Every word, and only the NUS-WIDE tags and concepts that training looks up
+ingest_vectors('data/wiki-news-300d-1M.vec', 'pickles/word_embeddings/word_embeddings')
+ingest_vectors('data/wiki-news-300d-1M.vec', 'pickles/word_embeddings/nuswide_word_embeddings',
+               vocabulary = load_vocabulary('data/nuswide_metadata/TagList1k.txt', 'data/nuswide_metadata/Concepts81.txt'))
 print("Done processing word vectors!")
 
 print("Downloading NUSWIDE...(this will take a lot of time)")
@@ -0,0 +1,57 @@
+import numpy as np
+import os
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from dime.engine import SearchEngine
+from dime.index import load_index
+
+class Net(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.fc = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(3 * 16 * 16, 32))
+
+    def forward(self, x):
+        return self.fc(x)
+
+def make_images(root, start, stop):
+    for i in range(start, stop):
+        directory = f"{root}/data/imgs/{'ab'[i % 2]}"
+        os.makedirs(directory, exist_ok = True)
+        image = (np.random.RandomState(i).rand(16, 16, 3) * 255).astype("uint8")
+        Image.fromarray(image).save(f"{directory}/{i:05d}.png")
+
+def make_engine(root):
+    for directory in ["data", "idx", "models", "emb"]:
+        os.makedirs(f"{root}/{directory}", exist_ok = True)
+    engine = SearchEngine({"name": f"{root}/e", "cuda": False, "verbose": False, "dataset_dir": f"{root}/data",
+        "index_dir": f"{root}/idx", "model_dir": f"{root}/models", "embedding_dir": f"{root}/emb", "modalities": ["image"]})
+    engine.add_dataset({"name": "imgs", "data_dir": "imgs", "transform": transforms.ToTensor(), "modality": "image",
+        "dim": (3, 16, 16), "desc": ""})
+    engine.add_model({"name": "net", "output_dim": (32,), "modalities": ["image"], "embedding_nets": [Net()],
+        "input_dim": [(3, 16, 16)], "desc": ""})
+    return engine
+
+def test_add_items_to_reloaded_sharded_ivf_index(tmp_path):
+    root = str(tmp_path)
+    make_images(root, 0, 100)
+    engine = make_engine(root)
+    engine.build_index({"name": "sharded", "model_name": "net", "dataset_name": "imgs", "index_type": "ivf_flat",
+        "nlist": 8, "num_shards": 2}, batch_size = 32)
+    engine.indexes["sharded"].save()
+
+    index = load_index(engine, "sharded")
+    engine.add_index(index)
+    assert index.synced and index.is_trained()
+
+    make_images(root, 100, 105)
+    new, _ = engine.datasets["imgs"].scan()
+    ids = engine.add_items("imgs", new, save = False)
+    assert len(index) == 105
+
+    query = engine.target_to_tensor(engine.idx_to_target(int(ids[0]), "imgs"), "imgs")
+    _, idx = engine.search(query, "image", "sharded", n = 1)
+    assert idx[0] == ids[0]
+    index.close()
@@ -5,6 +5,7 @@ import csv
 import pickle
 import torch
 
+from dime.vectors import load_vectors
 from trainer import fit
 from datasets import NUS_WIDE
 
@@ -25,7 +26,7 @@ cuda = torch.cuda.is_available()
 
 # setting up dictionary
 print("Loading in word vectors...")
-text_dictionary = pickle.load(open("pickles/word_embeddings/word_embeddings_tensors.p", "rb"))
+text_dictionary = load_vectors("pickles/word_embeddings/nuswide_word_embeddings")
 print("Done\n")
 
 mean, std = (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)